@@ -0,0 +1,168 @@
+from __future__ import division
+import time
+import numpy as np
+from scipy.ndimage import affine_transform, gaussian_filter
+
+
+class VolumeAugmenter(object):
+    '''
+    3D data augmentation of a training patch (flips, 90 degree rotations, arbitrary rotation in the axial plane
+    and Gaussian blur), there is no intensity scaling since the volume normalization of the patch cancels it.
+    The transforms are sampled once per patch and applied jointly to all the image channels and the label, the
+    geometric ones in a single resampling pass. The patch is cropped with a margin (see margin()) so that the
+    rotated patch does not read outside of the crop.
+    '''
+
+    def __init__(self, flip_prob=0.5, rot90=True, rotate_range=45, blur_sigma=(0.0, 4.0), min_ops=1, max_ops=4,
+                 report_intval=0, seed=None):
+        '''
+        :param flip_prob: probability of the flip of each axial axis
+        :param rot90: enable the rotations by 90, 180 or 270 degree
+        :param rotate_range: maximum angle (degree) of the arbitrary rotation, 0 disables it
+        :param blur_sigma: range of the sigma of the axial Gaussian blur, None disables it
+        :param min_ops: minimum number of transforms applied to a patch
+        :param max_ops: maximum number of transforms applied to a patch
+        :param report_intval: print the timing report every report_intval patches, 0 disables it
+        :param seed: random seed
+        '''
+        self.flip_prob = flip_prob
+        self.rotate_range = rotate_range
+        self.blur_sigma = blur_sigma
+        self.min_ops = min_ops
+        self.max_ops = max_ops
+        self.report_intval = report_intval
+        self.ops = ["flip_x", "flip_y"]
+        if rot90:
+            self.ops.append("rot90")
+        if blur_sigma is not None and blur_sigma[1] > 0:
+            self.ops.append("blur")
+        if rotate_range > 0:
+            self.ops.append("rotate")
+        self.rng = np.random.RandomState(seed)
+        # accumulated time (s) and number of calls of every step
+        self.timings = {}
+        self.num_patches = 0
+
+    def reseed(self, seed):
+        self.rng.seed(seed)
+
+    def margin(self, extent):
+        '''
+        axial margin needed around a patch of the given extent
+        :return: margin of the three axes
+        '''
+        half = extent / 2.0
+        rotate_margin = 0
+        if "rotate" in self.ops:
+            angle = np.deg2rad(min(self.rotate_range, 45))
+            rotate_margin = int(np.ceil(half * (np.cos(angle) + np.sin(angle) - 1)))
+        blur_margin = int(np.ceil(3 * self.blur_sigma[1])) if "blur" in self.ops else 0
+        axial_margin = rotate_margin + blur_margin
+        return axial_margin, axial_margin, 0
+
+    def sample(self, rng=None):
+        '''
+        sample the transforms of a patch
+        :param rng: RandomState to use instead of the one of the augmenter
+        :return: dict of the transform parameters
+        '''
+        rng = rng if rng is not None else self.rng
+        num_ops = rng.randint(self.min_ops, min(self.max_ops, len(self.ops)) + 1)
+        selected = rng.choice(len(self.ops), num_ops, replace=False)
+        params = {"flips": [], "rot90": 0, "angle": 0.0, "sigma": 0.0}
+        for op in [self.ops[k] for k in selected]:
+            if op == "flip_x":
+                if rng.rand() < self.flip_prob:
+                    params["flips"].append(1)
+            elif op == "flip_y":
+                if rng.rand() < self.flip_prob:
+                    params["flips"].append(0)
+            elif op == "rot90":
+                params["rot90"] = rng.randint(1, 4)
+            elif op == "blur":
+                params["sigma"] = rng.uniform(*self.blur_sigma)
+            elif op == "rotate":
+                params["angle"] = rng.uniform(-self.rotate_range, self.rotate_range)
+        return params
+
+    @staticmethod
+    def _axial_matrix(params):
+        # output -> input coordinates (centered) of the flips and rotations, the depth axis is kept
+        angle = np.deg2rad(params["angle"] + 90 * params["rot90"])
+        rotation = np.eye(3)
+        rotation[:2, :2] = [[np.cos(angle), -np.sin(angle)], [np.sin(angle), np.cos(angle)]]
+        flip = np.eye(3)
+        for axis in params["flips"]:
+            flip[axis, axis] = -1
+        return np.round(flip.dot(rotation), 12)
+
+    def _timed(self, name, start_time):
+        elapsed = self.timings.setdefault(name, [0.0, 0])
+        elapsed[0] += time.time() - start_time
+        elapsed[1] += 1
+
+    def report(self):
+        '''
+        :return: average time (ms) of every step per patch
+        '''
+        return ", ".join("%s %.2fms" % (name, 1000 * total / max(calls, 1))
+                         for name, (total, calls) in sorted(self.timings.items()))
+
+    def __call__(self, images, label, origin, extent, rng=None):
+        '''
+        augment a patch
+        :param images: list of the image volumes of the crop (patch and margin)
+        :param label: label volume of the crop (integer codes, nearest neighbour)
+        :param origin: position of the patch in the crop, the margin may stick out of the crop
+        :param extent: size of the cubic patch
+        :param rng: RandomState to use instead of the one of the augmenter
+        :return: augmented image patches and label patch
+        '''
+        start_time = time.time()
+        params = self.sample(rng)
+        self._timed("sample", start_time)
+
+        # the blur is isotropic in the axial plane so it commutes with the rotations
+        if params["sigma"] > 0:
+            start_time = time.time()
+            images = [gaussian_filter(img, sigma=(params["sigma"], params["sigma"], 0), truncate=3.0)
+                      for img in images]
+            self._timed("blur", start_time)
+
+        start_time = time.time()
+        matrix = self._axial_matrix(params)
+        step = "flip" if params["angle"] == 0 else "resample"
+        if params["angle"] == 0:
+            # flips and 90 degree rotations are exact: axis permutation and reversal of the patch
+            patch = tuple(slice(o, o + extent) for o in origin)
+            perm = [0, 1, 2]
+            flips = []
+            for i in range(2):
+                k = int(np.argmax(np.abs(matrix[i, :2])))
+                perm[k] = i
+                if matrix[i, k] < 0:
+                    flips.append(k)
+
+            def transform(volume, order):
+                out = np.transpose(volume[patch], perm)
+                if flips:
+                    out = np.flip(out, axis=tuple(flips))
+                return np.ascontiguousarray(out)
+
+        else:
+            # one resampling pass of the crop for the composed transform
+            center = (extent - 1) / 2.0
+            offset = np.array(origin, dtype="float64") + center - matrix.dot(np.full(3, center))
+
+            def transform(volume, order):
+                return affine_transform(volume, matrix, offset=offset, output_shape=(extent,) * 3,
+                                        order=order, mode="constant", cval=0)
+
+        images = [transform(img, 1) for img in images]
+        label = transform(label, 0)
+        self._timed(step, start_time)
+
+        self.num_patches += 1
+        if self.report_intval and self.num_patches % self.report_intval == 0:
+            print("augmentation (%d patches): %s" % (self.num_patches, self.report()))
+        return images, label
@@ -0,0 +1,192 @@
+from __future__ import division
+import json
+import struct
+import zlib
+import threading
+from collections import OrderedDict
+import numpy as np
+
+# optional codecs, zlib is always available
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CHUNK_MAGIC = b"BRCHUNK1"
+CHUNK_PREFIX = struct.Struct("<8sQ")
+
+
+def _compressor(codec, level):
+    if codec == "none":
+        return lambda data: data
+    if codec == "zlib":
+        return lambda data: zlib.compress(data, level)
+    if codec == "lz4":
+        if lz4_frame is None:
+            raise Exception("the lz4 codec requires the lz4 package")
+        return lambda data: lz4_frame.compress(data, compression_level=level)
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("the zstd codec requires the zstandard package")
+        return zstandard.ZstdCompressor(level=level).compress
+    raise Exception("unknown chunk codec: %s" % codec)
+
+
+def _decompressor(codec):
+    if codec == "none":
+        return lambda data: data
+    if codec == "zlib":
+        return zlib.decompress
+    if codec == "lz4":
+        if lz4_frame is None:
+            raise Exception("the lz4 codec requires the lz4 package")
+        return lz4_frame.decompress
+    if codec == "zstd":
+        if zstandard is None:
+            raise Exception("the zstd codec requires the zstandard package")
+        return zstandard.ZstdDecompressor().decompress
+    raise Exception("unknown chunk codec: %s" % codec)
+
+
+def write_chunked(f, data, chunk_size=32, codec="zlib", level=1):
+    '''
+    write a 3D volume as independently compressed chunk_size^3 chunks
+    :param f: file opened in binary mode
+    :param data: volume data
+    :param chunk_size: edge length of the chunks
+    :param codec: none/zlib/lz4/zstd
+    :param level: compression level
+    '''
+    data = np.asarray(data)
+    compress = _compressor(codec, level)
+    grid = [int(np.ceil(d / chunk_size)) for d in data.shape]
+    blobs = []
+    for i in range(grid[0]):
+        for j in range(grid[1]):
+            for k in range(grid[2]):
+                block = data[i * chunk_size:(i + 1) * chunk_size,
+                             j * chunk_size:(j + 1) * chunk_size,
+                             k * chunk_size:(k + 1) * chunk_size]
+                blobs.append(compress(np.ascontiguousarray(block).tobytes()))
+    # offset of every chunk after the offset table, chunk (i, j, k) is number (i * grid[1] + j) * grid[2] + k
+    offsets = np.zeros(len(blobs) + 1, dtype="<i8")
+    offsets[1:] = np.cumsum([len(blob) for blob in blobs])
+    header = json.dumps({"shape": list(data.shape), "dtype": data.dtype.str, "chunk_size": chunk_size,
+                         "codec": codec, "grid": grid}).encode("utf-8")
+    f.write(CHUNK_PREFIX.pack(CHUNK_MAGIC, len(header)))
+    f.write(header)
+    f.write(offsets.tobytes())
+    for blob in blobs:
+        f.write(blob)
+
+
+class ChunkedVolume(object):
+    '''
+    read-only 3D volume stored by write_chunked. Slicing with unit steps only reads and decompresses the
+    chunks intersecting the requested box; the last decompressed chunks are kept for overlapping patches.
+    '''
+
+    def __init__(self, path, max_cached_chunks=32):
+        self.path = path
+        with open(path, "rb") as f:
+            magic, header_len = CHUNK_PREFIX.unpack(f.read(CHUNK_PREFIX.size))
+            if magic != CHUNK_MAGIC:
+                raise Exception("not a chunked volume: %s" % path)
+            header = json.loads(f.read(header_len).decode("utf-8"))
+            self.grid = header["grid"]
+            num_chunks = self.grid[0] * self.grid[1] * self.grid[2]
+            self.offsets = np.frombuffer(f.read(8 * (num_chunks + 1)), dtype="<i8")
+        self.data_start = CHUNK_PREFIX.size + header_len + 8 * (num_chunks + 1)
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.ndim = len(self.shape)
+        self.nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.chunk_size = header["chunk_size"]
+        self.codec = header["codec"]
+        self.max_cached_chunks = max_cached_chunks
+        self.chunk_cache = OrderedDict()
+        # the tf.data pipeline reads from several threads
+        self.lock = threading.Lock()
+
+    @property
+    def resident_bytes(self):
+        # upper bound of the memory held by the volume (its cache of decompressed chunks)
+        return min(self.nbytes, self.max_cached_chunks * self.chunk_size ** 3 * self.dtype.itemsize)
+
+    def __getstate__(self):
+        # the decompressed chunks are not sent to the loader processes
+        state = self.__dict__.copy()
+        state["chunk_cache"] = OrderedDict()
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def _chunk(self, f, index):
+        with self.lock:
+            if index in self.chunk_cache:
+                self.chunk_cache.move_to_end(index)
+                return self.chunk_cache[index]
+        i, j, k = index
+        n = (i * self.grid[1] + j) * self.grid[2] + k
+        f.seek(self.data_start + int(self.offsets[n]))
+        data = _decompressor(self.codec)(f.read(int(self.offsets[n + 1] - self.offsets[n])))
+        chunk_shape = tuple(min(self.chunk_size, d - c * self.chunk_size) for c, d in zip(index, self.shape))
+        block = np.frombuffer(data, dtype=self.dtype).reshape(chunk_shape)
+        if self.max_cached_chunks > 0:
+            with self.lock:
+                self.chunk_cache[index] = block
+                while len(self.chunk_cache) > self.max_cached_chunks:
+                    self.chunk_cache.popitem(last=False)
+        return block
+
+    def read_box(self, box):
+        '''
+        read a box of the volume
+        :param box: list of (start, end) of the three axes, within the volume
+        :return: ndarray of the box
+        '''
+        out = np.empty([end - start for start, end in box], dtype=self.dtype)
+        chunk_ranges = [range(start // self.chunk_size, (end - 1) // self.chunk_size + 1) if end > start else []
+                        for start, end in box]
+        with open(self.path, "rb") as f:
+            for i in chunk_ranges[0]:
+                for j in chunk_ranges[1]:
+                    for k in chunk_ranges[2]:
+                        block = self._chunk(f, (i, j, k))
+                        src = []
+                        dst = []
+                        for c, (start, end) in zip((i, j, k), box):
+                            lo = max(start, c * self.chunk_size)
+                            hi = min(end, (c + 1) * self.chunk_size)
+                            src.append(slice(lo - c * self.chunk_size, hi - c * self.chunk_size))
+                            dst.append(slice(lo - start, hi - start))
+                        out[tuple(dst)] = block[tuple(src)]
+        return out
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key = (key,)
+        ellipsis = [e for e, s in enumerate(key) if s is Ellipsis]
+        if len(ellipsis) == 1:
+            e = ellipsis[0]
+            key = key[:e] + (slice(None),) * (self.ndim - len(key) + 1) + key[e + 1:]
+        key = key + (slice(None),) * (self.ndim - len(key))
+        if len(key) == self.ndim and all(isinstance(s, slice) and s.step in (None, 1) for s in key):
+            box = []
+            for s, d in zip(key, self.shape):
+                start, stop, _ = s.indices(d)
+                box.append((start, max(start, stop)))
+            return self.read_box(box)
+        # anything else (strides, integer or boolean indices) on the whole volume
+        return self.read_box([(0, d) for d in self.shape])[key]
+
+    def __array__(self, dtype=None):
+        data = self.read_box([(0, d) for d in self.shape])
+        return data if dtype is None else data.astype(dtype)
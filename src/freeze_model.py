@@ -0,0 +1,169 @@
+from __future__ import division
+import os
+import sys
+import numpy as np
+import tensorflow as tf
+import models
+from utils import load_train_ini
+from operations import CascadedModel
+
+# outputs kept by the frozen graph (the inputs are the stage placeholders)
+OUTPUT_NODES = ["stage1_pred_prob", "stage1_pred_label", "stage2_pred_label", "stage3_pred_label"]
+# largest difference between the folded and the moving graphs: stage 1 logits relative to their range and
+# fraction of the voxels with different stage 2/3 labels
+FOLD_TOLERANCE = 1e-3
+
+
+def checkpoint_path(param_set):
+    '''
+    :return: path of the checkpoint of the step of param_set, as written by CascadedModel.save_chkpoint
+    '''
+    model_dir = "%s_%s_%s" % (param_set['batch_size'], param_set['outputI_size'], param_set['step'])
+    checkpoint_dir = os.path.join(param_set['chkpoint_dir'], model_dir)
+    ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+    if not (ckpt and ckpt.model_checkpoint_path):
+        raise Exception("no checkpoint in %s" % checkpoint_dir)
+    return os.path.join(checkpoint_dir, os.path.basename(ckpt.model_checkpoint_path))
+
+
+def foldable_scopes(layers):
+    '''
+    batch norm layers that can be folded into their convolution: the convolution output (and its bias) is only
+    used by the layer. The others (after a residual sum, or sharing the convolution output with a sum) stay a
+    per-channel affine.
+    :param layers: models.folded_bn_layers of a graph built in the folded mode
+    :return: set of the scopes of the foldable layers
+    '''
+    return set(scope for scope, kernel_name, bias_name, axis, bn_input, conv_output in layers
+               if kernel_name is not None and len(bn_input.consumers()) == 1 and
+               len(conv_output.consumers()) == 1)
+
+
+def find_foldable(param_set):
+    '''
+    build the folded graph with every layer as an affine and find the layers to fold into their convolution
+    :return: set of the scopes of the foldable layers
+    '''
+    models.set_bn_mode("folded")
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        CascadedModel(sess, dict(param_set, phase="export", frozen_graph=""))
+        return foldable_scopes(models.folded_bn_layers)
+
+
+def fold_batch_norm(values, layers, fold_scopes, epsilon=1e-5):
+    '''
+    fold the moving statistics of the batch norm layers:
+    folded layers: kernel * gamma / sqrt(var + eps) and beta - (mean - bias) * gamma / sqrt(var + eps)
+    other layers: gamma / sqrt(var + eps) and beta - mean * gamma / sqrt(var + eps) (affine of the layer)
+    :param values: dict variable name -> value of the checkpoint
+    :param layers: models.folded_bn_layers of a graph built in the folded mode
+    :param fold_scopes: scopes of the layers folded into their convolution
+    :return: dict variable name -> folded value (kernels, biases, gammas and betas)
+    '''
+    folded = {}
+    for scope, kernel_name, bias_name, axis, bn_input, conv_output in layers:
+        scale = values[scope + "/gamma"] / np.sqrt(values[scope + "/moving_variance"] + epsilon)
+        shift = values[scope + "/beta"] - values[scope + "/moving_mean"] * scale
+        dtype = values[scope + "/beta"].dtype
+        if scope in fold_scopes:
+            kernel = values[kernel_name]
+            shape = [1] * kernel.ndim
+            shape[axis] = -1
+            folded[kernel_name] = (kernel * scale.reshape(shape)).astype(kernel.dtype)
+            if bias_name is not None:
+                # the bias of the convolution goes into the folded bias
+                shift = shift + values[bias_name] * scale
+                folded[bias_name] = np.zeros_like(values[bias_name])
+        else:
+            folded[scope + "/gamma"] = scale.astype(dtype)
+        folded[scope + "/beta"] = shift.astype(dtype)
+    return folded
+
+
+def build_frozen(param_set, values, start_path, bn_mode, fold_scopes=()):
+    '''
+    build the inference graph, load the checkpoint values and convert the variables to constants
+    :return: frozen GraphDef and models.folded_bn_layers of the graph
+    '''
+    models.set_bn_mode(bn_mode, fold_scopes)
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        CascadedModel(sess, dict(param_set, phase="export", frozen_graph=""))
+        layers = list(models.folded_bn_layers)
+        folded = fold_batch_norm(values, layers, fold_scopes) if bn_mode == "folded" else {}
+        for var in tf.global_variables():
+            name = var.op.name
+            if name not in values:
+                raise Exception("variable %s is not in the checkpoint %s" % (name, start_path))
+            var.load(folded.get(name, values[name]), sess)
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), OUTPUT_NODES)
+    return graph_def, layers
+
+
+def run_frozen(graph_def, feed):
+    '''
+    :param feed: dict input tensor name -> value
+    :return: stage 1 logits and stage 2 and 3 labels of the frozen graph
+    '''
+    graph = tf.Graph()
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+        tf.import_graph_def(graph_def, name="")
+        return sess.run(["stage1_pred_prob:0", "stage2_pred_label:0", "stage3_pred_label:0"],
+                        feed_dict=dict((name + ":0", value) for name, value in feed.items()))
+
+
+def compare_frozen(folded_def, moving_def, param_set, seed=1):
+    '''
+    run the folded and the moving graphs on a random cube
+    :return: largest difference of the stage 1 logits relative to their range, fraction of the voxels with
+             different stage 2 or 3 labels
+    '''
+    rng = np.random.RandomState(seed)
+    size = param_set['inputI_size']
+    t1ce = rng.randn(1, size, size, size, 1).astype("float32")
+    feed = {"stage1_inputI": rng.randn(1, size, size, size, param_set['inputI_chn']).astype("float32"),
+            "stage2_inputI": t1ce, "stage3_inputI": t1ce}
+    folded_logits, folded_stage2, folded_stage3 = run_frozen(folded_def, feed)
+    moving_logits, moving_stage2, moving_stage3 = run_frozen(moving_def, feed)
+    difference = np.abs(folded_logits - moving_logits).max() / max(np.abs(moving_logits).max(), 1e-12)
+    mismatch = max(np.mean(folded_stage2 != moving_stage2), np.mean(folded_stage3 != moving_stage3))
+    return difference, mismatch
+
+
+def freeze(param_set, output_path, bn_mode="folded"):
+    '''
+    export the checkpoint of param_set as a frozen inference graph (stage placeholders to stage outputs). A folded
+    graph is checked against the moving graph on a random cube.
+    :param param_set: parameters of parameters.ini
+    :param output_path: path of the GraphDef
+    :param bn_mode: batch norm of the graph, moving or folded (see models.set_bn_mode)
+    '''
+    if bn_mode not in ("moving", "folded"):
+        # the batch statistics also update the moving averages, which are constants in a frozen graph
+        raise Exception("a frozen graph uses the moving or folded batch norm, not %s" % bn_mode)
+    start_path = checkpoint_path(param_set)
+    reader = tf.train.load_checkpoint(start_path)
+    values = dict((name, reader.get_tensor(name)) for name in reader.get_variable_to_shape_map())
+    moving_def, layers = build_frozen(param_set, values, start_path, "moving")
+    graph_def = moving_def
+    fold_scopes = set()
+    if bn_mode == "folded":
+        fold_scopes = find_foldable(param_set)
+        graph_def, layers = build_frozen(param_set, values, start_path, "folded", fold_scopes)
+        difference, mismatch = compare_frozen(graph_def, moving_def, param_set)
+        print("folded - moving: stage 1 logits %.2e of their range, stage 2/3 labels %.2e of the voxels" % (
+            difference, mismatch))
+        if difference > FOLD_TOLERANCE or mismatch > FOLD_TOLERANCE:
+            raise Exception("the folded graph does not match the moving graph (%.2e, %.2e)" % (difference, mismatch))
+    with tf.gfile.GFile(output_path, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    print("%s (%s batch norm, %d of %d layers folded into their convolution) written to %s" % (
+        start_path, bn_mode, len(fold_scopes), len(layers), output_path))
+
+
+if __name__ == "__main__":
+    # python freeze_model.py <output.pb> [moving|folded], the checkpoint (chkpoint_dir, step) and the model
+    # are read from parameters.ini
+    param_sets = load_train_ini("parameters.ini")
+    freeze(param_sets[0], sys.argv[1], sys.argv[2] if len(sys.argv) > 2 else "folded")
@@ -21,14 +21,7 @@ def unet(inputI, output_channel):
         use_bias=False,
         name='conv1')
     # conv1_1 (1, 96, 96, 96, 64)
-    conv1_bn = tf.contrib.layers.batch_norm(
-        conv1_1,
-        decay=0.9,
-        updates_collections=None,
-        epsilon=1e-5,
-        scale=True,
-        is_training=phase_flag,
-        scope="conv1_batch_norm")
+    conv1_bn = batch_norm_layer(conv1_1, is_training=phase_flag, scope="conv1_batch_norm")
     conv1_relu = tf.nn.relu(conv1_bn, name='conv1_relu')
 
     pool1_in = tf.layers.max_pooling3d(
@@ -50,14 +43,7 @@ def unet(inputI, output_channel):
         use_bias=False,
         name='conv2')
     # (1, 48, 48, 48, 128)
-    conv2_bn = tf.contrib.layers.batch_norm(
-        conv2_1,
-        decay=0.9,
-        updates_collections=None,
-        epsilon=1e-5,
-        scale=True,
-        is_training=phase_flag,
-        scope="conv2_batch_norm")
+    conv2_bn = batch_norm_layer(conv2_1, is_training=phase_flag, scope="conv2_batch_norm")
     conv2_relu = tf.nn.relu(conv2_bn, name='conv2_relu')
 
     pool2_in = tf.layers.max_pooling3d(
@@ -80,14 +66,7 @@ def unet(inputI, output_channel):
         use_bias=False,
         name='conv3a')
     # (1, 24, 24, 24, 256)
-    conv3_1_bn = tf.contrib.layers.batch_norm(
-        conv3_1,
-        decay=0.9,
-        updates_collections=None,
-        epsilon=1e-5,
-        scale=True,
-        is_training=phase_flag,
-        scope="conv3_1_batch_norm")
+    conv3_1_bn = batch_norm_layer(conv3_1, is_training=phase_flag, scope="conv3_1_batch_norm")
     conv3_1_relu = tf.nn.relu(conv3_1_bn, name='conv3_1_relu')
     conv3_2 = conv3d(
         input=conv3_1_relu,
@@ -98,14 +77,7 @@ def unet(inputI, output_channel):
         name='conv3b')
     # (1, 24, 24, 24, 256)
     conv3_2 = conv3_2 + conv3_1
-    conv3_2_bn = tf.contrib.layers.batch_norm(
-        conv3_2,
-        decay=0.9,
-        updates_collections=None,
-        epsilon=1e-5,
-        scale=True,
-        is_training=phase_flag,
-        scope="conv3_2_batch_norm")
+    conv3_2_bn = batch_norm_layer(conv3_2, is_training=phase_flag, scope="conv3_2_batch_norm")
     conv3_2_relu = tf.nn.relu(conv3_2_bn, name='conv3_2_relu')
 
     pool3_in = tf.layers.max_pooling3d(
@@ -128,14 +100,7 @@ def unet(inputI, output_channel):
         use_bias=False,
         name='conv4a')
     # conv4_1 (1, 12, 12, 12, 512)
-    conv4_1_bn = tf.contrib.layers.batch_norm(
-        conv4_1,
-        decay=0.9,
-        updates_collections=None,
-        epsilon=1e-5,
-        scale=True,
-        is_training=phase_flag,
-        scope="conv4_1_batch_norm")
+    conv4_1_bn = batch_norm_layer(conv4_1, is_training=phase_flag, scope="conv4_1_batch_norm")
     conv4_1_relu = tf.nn.relu(conv4_1_bn, name='conv4_1_relu')
     conv4_2 = conv3d(
         input=conv4_1_relu,
@@ -146,14 +111,7 @@ def unet(inputI, output_channel):
         name='conv4b')
     conv4_2 = conv4_2 + conv4_1
     # conv4_2 (1, 12, 12, 12, 512)
-    conv4_2_bn = tf.contrib.layers.batch_norm(
-        conv4_2,
-        decay=0.9,
-        updates_collections=None,
-        epsilon=1e-5,
-        scale=True,
-        is_training=phase_flag,
-        scope="conv4_2_batch_norm")
+    conv4_2_bn = batch_norm_layer(conv4_2, is_training=phase_flag, scope="conv4_2_batch_norm")
     conv4_2_relu = tf.nn.relu(conv4_2_bn, name='conv4_2_relu')
 
     pool4 = tf.layers.max_pooling3d(
@@ -469,6 +427,86 @@ def unet_resnet(input_pred, input_img, output_channel, stage):
     pred_label_v = tf.argmax(soft_prob_v, axis=4, name='argmax_v')
     return pred, pred_label_v
 
+# batch normalization of the graphs built afterwards, see set_bn_mode
+BN_MODES = ("batch", "moving", "folded")
+bn_mode = "batch"
+# folded mode: scopes of the batch norm layers folded into their convolution, the others are a per-channel affine
+folded_bn_scopes = set()
+# folded mode: (scope, kernel variable, bias variable, output channel axis of the kernel, input, convolution output)
+# of every batch norm layer, the kernel, bias, axis and convolution output are None when the input is not a convolution
+folded_bn_layers = []
+
+
+def set_bn_mode(mode, fold_scopes=()):
+    '''
+    select the batch normalization of the graphs built afterwards
+    :param mode: batch: statistics of the batch (as in training)
+                 moving: moving averages of the training
+                 folded: moving averages folded by freeze_model.py, the layers of fold_scopes only add their beta
+                 (the folded bias), the others are a per-channel affine (gamma and beta hold the scale and shift)
+    :param fold_scopes: scopes of the layers folded into the preceding convolution (folded mode)
+    '''
+    global bn_mode
+    if mode not in BN_MODES:
+        raise Exception("unknown batch norm mode: %s" % mode)
+    bn_mode = mode
+    folded_bn_scopes.clear()
+    folded_bn_scopes.update(fold_scopes)
+    del folded_bn_layers[:]
+
+
+def _variable_name(tensor):
+    # variable read by a tensor (through its read/identity ops)
+    op = tensor.op
+    while op.type not in ("VariableV2", "VarHandleOp"):
+        op = op.inputs[0].op
+    return op.name
+
+
+def batch_norm_layer(input, is_training, scope):
+    if bn_mode != "folded":
+        # moving: the moving averages of the training instead of the statistics of the batch
+        return tf.contrib.layers.batch_norm(
+            input,
+            decay=0.9,
+            updates_collections=None,
+            epsilon=1e-5,
+            scale=True,
+            is_training=is_training if bn_mode == "batch" else False,
+            scope=scope)
+    # folded: find the convolution (conv3d or Deconv3d) and its bias, if the layer follows one
+    conv_output = input
+    bias_name = None
+    if input.op.type == "BiasAdd":
+        conv_output = input.op.inputs[0]
+    if conv_output.op.type == "Conv3D":
+        axis = 4
+    elif conv_output.op.type == "Conv3DBackpropInputV2":
+        axis = 3
+    else:
+        # e.g. residual sums
+        axis = None
+    if axis is None:
+        kernel_name = None
+        conv_output = None
+    else:
+        kernel_name = _variable_name(conv_output.op.inputs[1])
+        if conv_output is not input:
+            bias_name = _variable_name(input.op.inputs[1])
+    channels = input.get_shape().as_list()[-1]
+    with tf.variable_scope(scope) as bn_scope:
+        beta = tf.get_variable("beta", shape=[channels], dtype=tf.float32, initializer=tf.zeros_initializer())
+        if bn_scope.name in folded_bn_scopes:
+            if kernel_name is None:
+                raise Exception("batch norm %s does not follow a 3D convolution" % scope)
+            output = tf.nn.bias_add(input, beta)
+        else:
+            gamma = tf.get_variable("gamma", shape=[channels], dtype=tf.float32, initializer=tf.ones_initializer())
+            output = tf.nn.bias_add(input * gamma, beta)
+    folded_bn_layers.append((bn_scope.name, kernel_name, bias_name, axis, input, conv_output))
+    return output
+
+
 def conv3d(
         input,
         output_chn,
@@ -507,22 +545,17 @@ def conv_bn_relu(
             stride,
             use_bias,
             name='conv')
-        bn = tf.contrib.layers.batch_norm(
-            conv,
-            decay=0.9,
-            updates_collections=None,
-            epsilon=1e-5,
-            scale=True,
-            is_training=is_training,
-            scope="batch_norm")
+        bn = batch_norm_layer(conv, is_training=is_training, scope="batch_norm")
         relu = tf.nn.relu(bn, name='relu')
     return relu
 
 
 # deconvolution
 def Deconv3d(input, output_chn, name):
-    batch, in_depth, in_height, in_width, in_channels = [
-        int(d) for d in input.get_shape()]
+    batch, in_depth, in_height, in_width, in_channels = input.get_shape().as_list()
+    if batch is None:
+        # dynamic batch dimension (test cubes)
+        batch = tf.shape(input)[0]
     filter = tf.get_variable(
         name + "/filter",
         shape=[
@@ -588,14 +621,7 @@ def deconv_bn_relu(input, output_chn, is_training, name):
     with tf.variable_scope(name):
         conv = Deconv3d(input, output_chn, name='deconv')
         # with tf.device("/cpu:0"):
-        bn = tf.contrib.layers.batch_norm(
-            conv,
-            decay=0.9,
-            updates_collections=None,
-            epsilon=1e-5,
-            scale=True,
-            is_training=is_training,
-            scope="batch_norm")
+        bn = batch_norm_layer(conv, is_training=is_training, scope="batch_norm")
         relu = tf.nn.relu(bn, name='relu')
     return relu
 
@@ -1,6 +1,7 @@
 from __future__ import division
 import os
 import time
+import json
 from glob import glob
 import cv2
 import scipy.ndimage
@@ -11,7 +12,12 @@ import tensorflow as tf
 import numpy as np
 import copy
 import nibabel as nib
-from imgaug import augmenters as iaa
+from augmentation import VolumeAugmenter
+
+# tensors of the inference graph found by name in a frozen graph
+INFERENCE_TENSORS = ["stage1_inputI", "stage2_inputI", "stage3_inputI", "stage1_pred_prob", "stage1_pred_label",
+                     "stage2_pred_label", "stage3_pred_label"]
+
 
 class CascadedModel(object):
 
@@ -35,18 +41,57 @@ class CascadedModel(object):
         self.testdata_dir = param_set['testdata_dir']
         self.labeling_dir = param_set['labeling_dir']
         self.ovlp_ita = param_set['ovlp_ita']
+        self.test_batch_size = param_set['test_batch_size']
+        self.cube_min_occupancy = param_set['cube_min_occupancy']
+        self.gated_inference = param_set['gated_inference']
+        self.gate_margin = param_set['gate_margin']
+        self.coarse_to_fine = param_set['coarse_to_fine']
+        self.coarse_resize_r = param_set['coarse_resize_r']
+        self.roi_margin = param_set['roi_margin']
+        self.test_bn_mode = param_set['test_bn_mode']
+        self.frozen_graph = param_set['frozen_graph']
         self.step = param_set['step']
         self.rename_map = param_set['rename_map']
-        self.rename_map = [int(s) for s in self.rename_map.split(',')]
         self.Blocks = param_set['Blocks']
         self.Columns = param_set['Columns']
         self.Stages = param_set['Stages']
         self.fg_ratio = param_set['fg_ratio']
         self.bg_ratio = param_set['bg_ratio']
         self.save_config = True  # whether save the config file,set default True
+        # generators of the datasets used by test_brain
+        self.test_generators = {}
+        # data stream position saved with the loaded checkpoint
+        self.sampler_state = None
         self.focal_loss_flag = param_set['focal_loss_flag']
-        # build model graph
-        self.build_cascade_model()
+        self.cache_dir = param_set['cache_dir']
+        self.manifest_dir = param_set['manifest_dir']
+        self.cache_format = param_set['cache_format']
+        self.chunk_codec = param_set['chunk_codec']
+        self.shm_dir = param_set['shm_dir']
+        self.shm_pool_mb = param_set['shm_pool_mb']
+        self.hist_match = param_set['hist_match']
+        self.aug_report_intval = param_set['aug_report_intval']
+        self.record_dir = param_set['record_dir']
+        self.shuffle_buffer = param_set['shuffle_buffer']
+        self.input_mode = param_set['input_mode']
+        self.dataset_cache = param_set['dataset_cache']
+        self.num_workers = param_set['num_workers']
+        self.prefetch_depth = param_set['prefetch_depth']
+        self.shared_buffers = param_set['shared_buffers']
+        self.fg_sample_ratio = param_set['fg_sample_ratio']
+        self.patches_per_volume = param_set['patches_per_volume']
+        self.pool_interleave = param_set['pool_interleave']
+        self.pool_size_mb = param_set['pool_size_mb']
+        # build model graph, the test phases only need the forward cascade
+        if self.phase == "train":
+            self.build_cascade_model()
+        else:
+            # the export phase of freeze_model.py selects the batch norm itself
+            if self.phase != "export":
+                if self.test_bn_mode == "folded":
+                    raise Exception("the folded batch norm is only built by freeze_model.py, set frozen_graph to use it")
+                set_bn_mode(self.test_bn_mode)
+            self.build_inference_model()
 
     # dice loss function
     def dice_loss_fun(self, pred, input_gt):
@@ -129,18 +174,160 @@ class CascadedModel(object):
         return loss
 
 
+    # input of the graph
+    @staticmethod
+    def input_tensor(default, dtype, shape, name=None):
+        if default is None:
+            return tf.placeholder(dtype=dtype, shape=shape, name=name)
+        return tf.placeholder_with_default(default, shape=shape, name=name)
+
+    # generator of the training patches
+    def build_train_generator(self):
+        # data augment
+        augmentation = VolumeAugmenter(flip_prob=0.5, rot90=True, rotate_range=45, blur_sigma=(0.0, 4.0),
+                                       min_ops=1, max_ops=4, report_intval=self.aug_report_intval)
+
+        return BatchGenerator(
+            batch_size=self.batch_size,
+            shuffle=True,
+            seed=1,
+            volume_path=self.traindata_dir,
+            modalities=self.inputI_chn,
+            resize_r=self.resize_r,
+            rename_map=self.rename_map,
+            patch_dim=self.outputI_size,
+            augmentation=augmentation,
+            cache_dir=self.cache_dir,
+            cache_format=self.cache_format,
+            chunk_codec=self.chunk_codec,
+            manifest_dir=self.manifest_dir,
+            shm_dir=self.shm_dir,
+            shm_pool_mb=self.shm_pool_mb,
+            hist_match=self.hist_match,
+            fg_sample_ratio=self.fg_sample_ratio,
+            patches_per_volume=self.patches_per_volume,
+            pool_interleave=self.pool_interleave,
+            pool_size_mb=self.pool_size_mb,
+            record_dir=self.record_dir,
+            shuffle_buffer=self.shuffle_buffer)
+
+    # tf.data input pipeline
+    def build_input_pipeline(self, generator):
+        '''
+        tf.data pipeline of the training batches: the brain boxes of the patients of the manifest are loaded
+        by parallel map calls (or streamed from the records), optionally cached, shuffled, interleaved over
+        pool_interleave patients and cut into patches. The batches are prefetched so that the copy to the
+        device overlaps with the training step.
+        :param generator: BatchGenerator of the training set
+        :return: batch tensors of the image, T1ce and the labels of the three stages
+        '''
+        num_calls = max(self.num_workers, 1)
+        # first sample number and shuffle seed, fed to the initializer when a training run is resumed
+        self.input_start = tf.placeholder_with_default(tf.constant(0, dtype=tf.int64), shape=[])
+        self.input_seed = tf.placeholder_with_default(tf.constant(generator.seed, dtype=tf.int64), shape=[])
+        box_types = (tf.int64, tf.int16, tf.uint8, tf.int64, tf.float32, tf.int32, tf.int64)
+        box_shapes = ([], [None, None, None, self.inputI_chn + 1], [None, None, None], [6],
+                      [self.inputI_chn + 1, 2], [None, 3], [3])
+
+        def set_shapes(*box):
+            for tensor, shape in zip(box, box_shapes):
+                tensor.set_shape(shape)
+            return box
+
+        if generator.records is not None:
+            # the records are already read sequentially through a shuffle buffer
+            boxes = tf.data.Dataset.from_generator(generator.record_boxes, box_types,
+                                                   tuple(tf.TensorShape(shape) for shape in box_shapes))
+        else:
+            # every epoch visits all the patients in a new order, as the feed mode does
+            boxes = tf.data.Dataset.range(generator.total_num)
+            if not self.dataset_cache:
+                # shuffle the patient indices, only the loaded boxes are buffered by the map calls
+                boxes = boxes.shuffle(generator.total_num, seed=self.input_seed, reshuffle_each_iteration=True)
+            boxes = boxes.map(lambda j: tuple(tf.py_func(generator.patient_box, [j], box_types)),
+                              num_parallel_calls=num_calls)
+            boxes = boxes.map(set_shapes)
+            if self.dataset_cache:
+                # the boxes are loaded once, in memory or in the given file, and shuffled over the whole dataset
+                boxes = boxes.cache("" if self.dataset_cache == "memory" else self.dataset_cache)
+                boxes = boxes.shuffle(generator.total_num, seed=self.input_seed, reshuffle_each_iteration=True)
+            boxes = boxes.repeat()
+        # patches_per_volume patches of every patient, taken in turn from pool_interleave patients
+        boxes = boxes.interleave(lambda *box: tf.data.Dataset.from_tensors(box).repeat(self.patches_per_volume),
+                                 cycle_length=self.pool_interleave, block_length=1)
+
+        patch_shape = [self.inputI_size] * 3
+        patch_types = (tf.float32, tf.float32, tf.int32, tf.int32, tf.int32)
+        patch_shapes = (patch_shape + [self.inputI_chn], patch_shape + [1], patch_shape, patch_shape, patch_shape)
+
+        def sample_patch(sample_index, box):
+            # the sample number seeds the patch, the order of the parallel calls does not matter
+            patch = tf.py_func(generator.dataset_sample, [sample_index] + list(box), patch_types)
+            for tensor, shape in zip(patch, patch_shapes):
+                tensor.set_shape(shape)
+            return tuple(patch)
+
+        patches = tf.data.Dataset.zip((tf.data.Dataset.range(self.input_start, 2 ** 62), boxes))
+        patches = patches.map(sample_patch, num_parallel_calls=num_calls)
+        dataset = patches.batch(self.batch_size, drop_remainder=True).prefetch(self.prefetch_depth)
+        self.train_iterator = dataset.make_initializable_iterator()
+        return self.train_iterator.get_next()
+
+    # build the forward cascade without the losses (test and gen_map phases)
+    def build_inference_model(self):
+        if self.frozen_graph:
+            # graph written by freeze_model.py, the tensors are found by name
+            graph_def = tf.GraphDef()
+            with tf.gfile.GFile(self.frozen_graph, "rb") as f:
+                graph_def.ParseFromString(f.read())
+            tf.import_graph_def(graph_def, name="")
+            graph = tf.get_default_graph()
+            for name in INFERENCE_TENSORS:
+                setattr(self, name, graph.get_tensor_by_name(name + ":0"))
+            self.saver = None
+            return
+        # same variables (names) as build_cascade_model, the checkpoints of the training are restored by name
+        self.stage1_inputI = tf.placeholder(dtype=tf.float32, shape=[None, self.inputI_size, self.inputI_size,
+                                                                     self.inputI_size, self.inputI_chn],
+                                            name='stage1_inputI')
+        stage1_pred_prob, stage1_pred_label, _, _, _ = unet(self.stage1_inputI, self.output_chn)
+        # named outputs (the frozen graph keeps them), stage1_pred_prob can be fed by the gated inference
+        self.stage1_pred_prob = tf.identity(stage1_pred_prob, name='stage1_pred_prob')
+        self.stage1_pred_label = tf.identity(stage1_pred_label, name='stage1_pred_label')
+        self.stage2_inputI = tf.placeholder(dtype=tf.float32, shape=[None, self.inputI_size, self.inputI_size,
+                                                                     self.inputI_size, 1], name='stage2_inputI')
+        self.stage2_pred_prob, stage2_pred_label = unet_resnet(self.stage1_pred_prob, self.stage2_inputI,
+                                                               self.output_chn, 'stage2')
+        self.stage2_pred_label = tf.identity(stage2_pred_label, name='stage2_pred_label')
+        self.stage3_inputI = tf.placeholder(dtype=tf.float32, shape=[None, self.inputI_size, self.inputI_size,
+                                                                     self.inputI_size, 1], name='stage3_inputI')
+        self.stage3_pred_prob, stage3_pred_label = unet_resnet(self.stage2_pred_prob, self.stage3_inputI,
+                                                               self.output_chn, 'stage3')
+        self.stage3_pred_label = tf.identity(stage3_pred_label, name='stage3_pred_label')
+        self.u_vars = tf.trainable_variables()
+        # create model saver
+        self.saver = tf.train.Saver(max_to_keep=20)
+
     # build cascade graph
     def build_cascade_model(self):
         # there exits three stages ,each stage for a specific class
 
         # stage1  3d-unet for the whole tumor
-        self.stage1_inputI = tf.placeholder(dtype=tf.float32, shape=[self.batch_size,
-                                                                     self.inputI_size, self.inputI_size,
-                                                                     self.inputI_size, self.inputI_chn],
-                                            name='stage1_inputI')
-        self.stage1_input_gt = tf.placeholder(dtype=tf.int32,
-                                              shape=[self.batch_size, self.inputI_size, self.inputI_size,
-                                                     self.inputI_size], name='stage1_input_gt')
+        # training batches read from a tf.data iterator, the placeholders can still be fed (test)
+        if self.input_mode == "dataset" and self.phase == "train":
+            self.train_generator = self.build_train_generator()
+            input_batch = self.build_input_pipeline(self.train_generator)
+        elif self.input_mode in ("feed", "dataset"):
+            input_batch = [None] * 5
+        else:
+            raise Exception("unknown input_mode: %s" % self.input_mode)
+        # the images have a dynamic batch dimension, test_brain feeds test_batch_size cubes at a time
+        self.stage1_inputI = self.input_tensor(input_batch[0], tf.float32,
+                                               [None, self.inputI_size, self.inputI_size,
+                                                self.inputI_size, self.inputI_chn], name='stage1_inputI')
+        self.stage1_input_gt = self.input_tensor(input_batch[2], tf.int32,
+                                                 [self.batch_size, self.inputI_size, self.inputI_size,
+                                                  self.inputI_size], name='stage1_input_gt')
         print("stage1 Input image", self.stage1_inputI)
         print("stage1 Input label:", self.stage1_input_gt)
         self.is_global_path = tf.placeholder(
@@ -156,22 +343,22 @@ class CascadedModel(object):
             self.stage1_inputI, self.output_chn)
 
         # stage2 unet_resnet for the tumor core
-        self.stage2_inputI = tf.placeholder(dtype=tf.float32,
-                                            shape=[self.batch_size, self.inputI_size, self.inputI_size,
-                                                   self.inputI_size, 1])
-        self.stage2_input_gt = tf.placeholder(dtype=tf.int32,
-                                              shape=[self.batch_size, self.inputI_size, self.inputI_size,
-                                                     self.inputI_size])
+        self.stage2_inputI = self.input_tensor(input_batch[1], tf.float32,
+                                               [None, self.inputI_size, self.inputI_size,
+                                                self.inputI_size, 1])
+        self.stage2_input_gt = self.input_tensor(input_batch[3], tf.int32,
+                                                 [self.batch_size, self.inputI_size, self.inputI_size,
+                                                  self.inputI_size])
         self.stage2_pred_prob, self.stage2_pred_label = unet_resnet(self.stage1_pred_prob, self.stage2_inputI,
                                                                   self.output_chn, 'stage2')
 
         # stage3 unet_resnet for the necrotic
-        self.stage3_inputI = tf.placeholder(dtype=tf.float32,
-                                            shape=[self.batch_size, self.inputI_size, self.inputI_size,
-                                                   self.inputI_size, 1])
-        self.stage3_input_gt = tf.placeholder(dtype=tf.int32,
-                                              shape=[self.batch_size, self.inputI_size, self.inputI_size,
-                                                     self.inputI_size])
+        self.stage3_inputI = self.input_tensor(input_batch[1], tf.float32,
+                                               [None, self.inputI_size, self.inputI_size,
+                                                self.inputI_size, 1])
+        self.stage3_input_gt = self.input_tensor(input_batch[4], tf.int32,
+                                                 [self.batch_size, self.inputI_size, self.inputI_size,
+                                                  self.inputI_size])
         self.stage3_pred_prob, self.stage3_pred_label = unet_resnet(self.stage2_pred_prob, self.stage3_inputI,
                                                                   self.output_chn, 'stage3')
 
@@ -240,8 +427,16 @@ class CascadedModel(object):
         self.log_writer = tf.summary.FileWriter("./logs", self.sess.graph)
 
         counter = 1
+        start_epoch = 0
+        start_batch = 0
         if self.load_chkpoint(self.chkpoint_dir, self.step):
             print(" [*] load checkpoint succeed..")
+            if self.sampler_state is not None:
+                # continue the data stream and the step counter of the checkpoint
+                counter = self.sampler_state["counter"]
+                start_epoch = self.sampler_state["epoch"]
+                start_batch = self.sampler_state["batch_index"]
+                print(" [*] resume at step %d, batch %d" % (counter, start_batch))
         else:
             print(" [!] load checkpoint failed...")
 
@@ -249,55 +444,56 @@ class CascadedModel(object):
         loss_log = open("loss.txt", "w")
         self.sess.graph.finalize()
 
-        # data augment
-        augmentation = iaa.SomeOf((1, 4), [
-            iaa.Fliplr(0.5),
-            iaa.Flipud(0.5),
-            iaa.OneOf([iaa.Affine(rotate=90),
-                       iaa.Affine(rotate=180),
-                       iaa.Affine(rotate=270)]),
-            iaa.Multiply((0.8, 1.5)),
-            iaa.GaussianBlur(sigma=(0.0, 4.0)),
-            iaa.Affine(rotate=(-45, 45))
-        ])
-
-
-        data_generator = BatchGenerator(
-            batch_size=self.batch_size,
-            shuffle=True,
-            seed=1,
-            volume_path=self.traindata_dir,
-            modalities=self.inputI_chn,
-            resize_r=self.resize_r,
-            rename_map=self.rename_map,
-            patch_dim=self.outputI_size,
-            augmentation=augmentation)
-        for epoch in np.arange(self.epoch):
+        if self.input_mode == "dataset":
+            data_generator = self.train_generator
+        else:
+            data_generator = self.build_train_generator()
+        if self.sampler_state is not None:
+            data_generator.check_sampler_state(self.sampler_state, self.input_mode)
+        # decompress the training set once
+        data_generator.build_cache()
+        if self.input_mode == "dataset":
+            # the graph reads the batches from the iterator
+            self.sess.run(self.train_iterator.initializer,
+                          feed_dict={self.input_start: start_batch * self.batch_size,
+                                     self.input_seed: data_generator.seed + start_batch})
+            data_loader = None
+        else:
+            # load the batches in worker processes while the session runs
+            data_loader = PrefetchLoader(data_generator, self.num_workers, self.prefetch_depth,
+                                         start_batch=start_batch, shared_buffers=self.shared_buffers)
+        batch_index = start_batch
+        for epoch in np.arange(start_epoch, self.epoch):
             start_time = time.time()
-            # get the training data
-            batch_img, batch_img2, batch_label, batch_label_stage2, batch_label_stage3 = next(data_generator)
-
-            # gt_onehot_te = tf.one_hot(self.input_gt, self.output_chn)
-            # gt_onehot = self.sess.run(gt_onehot_te, feed_dict={self.input_gt: batch_label})
-            # num_neg = np.sum(gt_onehot[:, :, :, :, 0])
-            # num_all = np.sum(gt_onehot)
-            # fore_ground = num_all - num_neg
-
-
-            # is_global_path, global_path_list, local_path_list = get_test_path_list(
-            #     self.Stages, self.Blocks, self.Columns)
-
-            # Update the network get the loss
-            _, cur_train_loss = self.sess.run([u_optimizer, self.all_stages_loss],
-                                              feed_dict={self.stage1_inputI: batch_img,
-                                                         self.stage1_input_gt: batch_label,
-                                                         self.stage2_inputI: batch_img2,
-                                                         self.stage2_input_gt: batch_label_stage2,
-                                                         self.stage3_inputI: batch_img2,
-                                                         self.stage3_input_gt: batch_label_stage3})
+            if data_loader is None:
+                # Update the network get the loss, the batch comes from the input pipeline
+                _, cur_train_loss = self.sess.run([u_optimizer, self.all_stages_loss])
+            else:
+                # get the training data
+                batch_img, batch_img2, batch_label, batch_label_stage2, batch_label_stage3 = next(data_loader)
+
+                # gt_onehot_te = tf.one_hot(self.input_gt, self.output_chn)
+                # gt_onehot = self.sess.run(gt_onehot_te, feed_dict={self.input_gt: batch_label})
+                # num_neg = np.sum(gt_onehot[:, :, :, :, 0])
+                # num_all = np.sum(gt_onehot)
+                # fore_ground = num_all - num_neg
+
+
+                # is_global_path, global_path_list, local_path_list = get_test_path_list(
+                #     self.Stages, self.Blocks, self.Columns)
+
+                # Update the network get the loss
+                _, cur_train_loss = self.sess.run([u_optimizer, self.all_stages_loss],
+                                                  feed_dict={self.stage1_inputI: batch_img,
+                                                             self.stage1_input_gt: batch_label,
+                                                             self.stage2_inputI: batch_img2,
+                                                             self.stage2_input_gt: batch_label_stage2,
+                                                             self.stage3_inputI: batch_img2,
+                                                             self.stage3_input_gt: batch_label_stage3})
             # self.log_writer.add_summary(summary_str, counter)
 
             counter += 1
+            batch_index += 1
             if np.mod(epoch, 2) == 0:
                 print(
                     "Epoch: [%2d] ：....time: %4.4f........................train_loss: %.8f" %
@@ -309,7 +505,11 @@ class CascadedModel(object):
                 self.test_brain(counter=counter, logname="test.log", dataset="test_set", save_pred=False,
                                 save_log_single=False, eval_flag=True)
 
-                self.save_chkpoint(self.chkpoint_dir, self.model_name, counter)
+                self.save_chkpoint(self.chkpoint_dir, self.model_name, counter,
+                                   sampler_state=data_generator.sampler_state(counter, epoch + 1, batch_index,
+                                                                              self.input_mode))
+        if data_loader is not None:
+            data_loader.close()
         loss_log.close()
 
 
@@ -335,16 +535,25 @@ class CascadedModel(object):
         else:
             raise Exception("Test dataset not specified!")
 
-        test_generator = BatchGenerator(
-            batch_size=self.batch_size,
-            shuffle=True,
-            seed=1,
-            volume_path=volume_path,
-            modalities=self.inputI_chn,
-            resize_r=self.resize_r,
-            rename_map=self.rename_map,
-            patch_dim=self.outputI_size,
-            augmentation=None)
+        # the generators of the test sets are built once, the file lists come from their manifests
+        if dataset not in self.test_generators:
+            self.test_generators[dataset] = BatchGenerator(
+                batch_size=self.batch_size,
+                shuffle=True,
+                seed=1,
+                volume_path=volume_path,
+                modalities=self.inputI_chn,
+                resize_r=self.resize_r,
+                rename_map=self.rename_map,
+                patch_dim=self.outputI_size,
+                augmentation=None,
+                cache_dir=self.cache_dir,
+                cache_format=self.cache_format,
+                chunk_codec=self.chunk_codec,
+                manifest_dir=self.manifest_dir,
+                shm_dir=self.shm_dir,
+                shm_pool_mb=self.shm_pool_mb)
+        test_generator = self.test_generators[dataset]
 
         eval_class = Evaluation()
 
@@ -369,7 +578,7 @@ class CascadedModel(object):
             print(dataset, "Processing:", os.path.basename(file_path))
 
 
-            vol_data, vol_data2, stage1_label, stage2_label, stage3_label, vol_ori = test_generator.load_volumes_label(
+            vol_data, vol_data2, stage1_label, stage2_label, stage3_label, ref_affine = test_generator.load_volumes_label(
                 file_path, True)
 
             if stage1_label== []:
@@ -378,7 +587,7 @@ class CascadedModel(object):
                 show_gt = True
 
             # reduce background region
-            regions = get_brain_region(np.squeeze(vol_data2, axis=-1))
+            regions = test_generator.brain_region(file_path, vol_data2[..., 0])
             vol_data_fg = vol_data[regions[0]:regions[1], regions[2]:regions[3], regions[4]:regions[5], :]
             vol_data2_fg = vol_data2[regions[0]:regions[1], regions[2]:regions[3], regions[4]:regions[5], :]
             if show_gt:
@@ -390,9 +599,7 @@ class CascadedModel(object):
                 stage2_label_fg = stage2_label
                 stage3_label_fg = stage3_label
 
-            ref_affine = vol_ori.affine
             # ref_affine = np.eye(4)
-            # data = vol_ori.get_data()
 
             resize_dim = (np.array(vol_data_fg.shape[0:3]) * self.resize_r).astype('int')
 
@@ -407,72 +614,51 @@ class CascadedModel(object):
             vol_data_norm = Preprocessing.Normalization(vol_data_resized.astype('float32'), axis=(0, 1, 2))
             vol_data2_norm = Preprocessing.Normalization(vol_data2_resized.astype("float32"))
 
-            # 将体数据分解为单个立方块，用于进行预测（此处cube_list维度为：cube_num个元素的一个list,其中
-            # 每个元素的维度为（1，cube_size,cube_size,cube_size,modalities））默认测试batch_size = 1
+            # 将体数据分解为立方块，用于进行预测: 立方块按批复制到重复使用的缓冲区中（维度为
+            # (test_batch_size,cube_size,cube_size,cube_size,modalities)），内存与重叠系数无关
             # 测试多通道版本
-            cube_list = decompose_vol2cube_brain(
-                vol_data_norm,
-                self.inputI_size,
-                self.inputI_chn,
-                self.ovlp_ita)
-            cube_list2 = decompose_vol2cube_brain(vol_data2_norm, self.inputI_size, 1, self.ovlp_ita)
-
-            # 获取预测出来的label
-            cube_label_list_WT = []
-            cube_label_list_TC = []
-            cube_label_list_ET = []
-            for c in range(len(cube_list)):
-                # 取出一个立方块 并且进行标准化(测试使用三个通道)
-                cube2test = cube_list[c]
-                cube2test_2 = cube_list2[c]
-                # cube2test_2 = cube_list[c][:,:,:,:,0:2]
-                # cube2test_3 = cube_list[c][:,:,:,:,0:1]
-
-                # mean_temp = np.mean(cube2test)
-                # dev_temp = np.std(cube2test)
-                # cube2test_norm = (cube2test - mean_temp) / dev_temp
-                if c % 20 == 0:
-                    print("predict %s MRI volume %s cube" % (i, c))
-                # 获取单个立方块的预测结果
-                self.sess.graph.finalize()
-                # cube_label, cube_prob = self.sess.run(
-                #     [self.pred_label,self.pred_prob],
-                #     feed_dict={
-                #         self.input_I: cube2test,
-                #         self.is_global_path: is_global_path,
-                #         self.global_path_list: global_path_list,
-                #         self.local_path_list: local_path_list})
-                cube_label_stage1, cube_label_stage2, cube_label_stage3 = self.sess.run(
-                    [self.stage1_pred_label, self.stage2_pred_label, self.stage3_pred_label],
-                    feed_dict={
-                        self.stage1_inputI: cube2test,
-                        self.stage2_inputI: cube2test_2,
-                        self.stage3_inputI: cube2test_2})
-                # sigmoid_pred =1 /(1+np.exp(-cube_prob))
-                # cube_label_list.append(cube_label)
-                cube_label_list_WT.append(cube_label_stage1)
-                cube_label_list_TC.append(cube_label_stage2)
-                cube_label_list_ET.append(cube_label_stage3)
-
-            # 将这些立方块的结果拼凑起来
-            composed_orig_WT = compose_label_cube2vol(
-                cube_label_list_WT,
-                resize_dim,
-                self.inputI_size,
-                self.ovlp_ita,
-                self.output_chn)
-            composed_orig_TC = compose_label_cube2vol(
-                cube_label_list_TC,
-                resize_dim,
-                self.inputI_size,
-                self.ovlp_ita,
-                self.output_chn)
-            composed_orig_NET = compose_label_cube2vol(
-                cube_label_list_ET,
-                resize_dim,
-                self.inputI_size,
-                self.ovlp_ita,
-                self.output_chn)
+            # coarse_to_fine: 先在降采样的脑区上用stage 1定位肿瘤, 只在肿瘤区域(roi)内进行全分辨率预测
+            if self.coarse_to_fine:
+                roi = self.coarse_roi(vol_data_fg, resize_dim, i)
+            else:
+                roi = [(0, d) for d in resize_dim]
+            composed_orig_WT = np.zeros(resize_dim, dtype="int64")
+            composed_orig_TC = np.zeros(resize_dim, dtype="int64")
+            composed_orig_NET = np.zeros(resize_dim, dtype="int64")
+            if roi is None:
+                cube_log = "%s cubes: no tumor found by the coarse pass" % os.path.basename(file_path)
+                print(cube_log)
+                test_log.write(cube_log + "\n")
+            else:
+                roi_crop = tuple(slice(start, end) for start, end in roi)
+                roi_origin = [start for start, end in roi]
+                roi_dim = [end - start for start, end in roi]
+                # 脑区占比低于cube_min_occupancy的立方块不送入网络，直接作为背景投票
+                brain_integral = integral_volume(np.any(vol_data_resized > 0, axis=-1) |
+                                                 (vol_data2_resized[..., 0] > 0))
+                min_occupancy = self.cube_min_occupancy * self.inputI_size ** 3
+                run_starts = []
+                culled_starts = []
+                for start in cube_coords(roi_dim, self.inputI_size, self.ovlp_ita):
+                    vol_start = [s + o for s, o in zip(start, roi_origin)]
+                    if cube_occupancy(brain_integral, vol_start, self.inputI_size) < min_occupancy:
+                        culled_starts.append(start)
+                    else:
+                        run_starts.append(start)
+                cube_log = "%s cubes: %d executed, %d culled, region %s of %s" % (
+                    os.path.basename(file_path), len(run_starts), len(culled_starts), roi_dim, list(resize_dim))
+                print(cube_log)
+                test_log.write(cube_log + "\n")
+
+                # 预测出来的label直接累加到投票中, 不保留立方块; 将这些立方块的结果拼凑起来
+                roi_WT, roi_TC, roi_NET, stage_log = self.predict_cubes(
+                    [vol_data_norm[roi_crop], vol_data2_norm[roi_crop]], roi_dim, run_starts, culled_starts, i)
+                composed_orig_WT[roi_crop] = roi_WT
+                composed_orig_TC[roi_crop] = roi_TC
+                composed_orig_NET[roi_crop] = roi_NET
+                if stage_log:
+                    print(stage_log)
+                    test_log.write("%s %s\n" % (os.path.basename(file_path), stage_log))
 
             # 此处将预测的标签 resize到之前的尺寸进行指标计算，但没有将标签值转换回原空间，因为只要两者一致即可
             '''
@@ -638,6 +824,9 @@ class CascadedModel(object):
                 # nib.save(labeling_vol, c_map_path)
                 nib.save(labeling_vol, c_map_path1)
 
+        # keep the brain regions computed during this round
+        test_generator.manifest.save()
+
         #########################################
         # 此处测试去除其中为0的影响
         mean_dice_WT_old = np.mean(all_dice_WT, axis=0)
@@ -709,13 +898,142 @@ class CascadedModel(object):
                                       average_mean_sensitivity))
         test_log.close()
 
+    # region of the tumor from a coarse stage 1 pass
+    def coarse_roi(self, vol_data_fg, vol_dim, vol_index):
+        '''
+        localize the whole tumor with stage 1 on the brain region downsampled by coarse_resize_r (cubes without
+        overlap) and return the region of the full resolution pass
+        :param vol_data_fg: images of the brain region
+        :param vol_dim: shape of the volume of the full resolution pass
+        :param vol_index: index of the volume in the progress messages
+        :return: (start, end) of the three axes of the region, None when no tumor is found
+        '''
+        coarse_dim = np.maximum((np.array(vol_data_fg.shape[0:3]) * self.coarse_resize_r).astype('int'),
+                                self.inputI_size)
+        coarse_data = resize(vol_data_fg.astype('float32'), coarse_dim, order=1, preserve_range=True)
+        coarse_norm = Preprocessing.Normalization(coarse_data.astype('float32'), axis=(0, 1, 2))
+        compositor = CubeCompositor(coarse_dim, self.inputI_size, 1, self.output_chn)
+        self.sess.graph.finalize()
+        for cube_starts, (cube2test,) in cube_batches([coarse_norm], self.inputI_size, 1, self.test_batch_size):
+            cube_label = self.sess.run(self.stage1_pred_label, feed_dict={self.stage1_inputI: cube2test})
+            compositor.add(cube_starts, cube_label)
+        coarse_WT = compositor.label() > 0
+        if not coarse_WT.any():
+            return None
+        roi = []
+        for axis in range(3):
+            indices = np.flatnonzero(coarse_WT.any(axis=tuple(a for a in range(3) if a != axis)))
+            scale = vol_dim[axis] / coarse_dim[axis]
+            start = max(int(np.floor(indices[0] * scale)) - self.roi_margin, 0)
+            end = min(int(np.ceil((indices[-1] + 1) * scale)) + self.roi_margin, vol_dim[axis])
+            # the region holds at least one cube
+            if end - start < self.inputI_size:
+                start = max(min(start, vol_dim[axis] - self.inputI_size), 0)
+                end = min(start + self.inputI_size, vol_dim[axis])
+            roi.append((int(start), int(end)))
+        print("predict %s MRI volume coarse region %s" % (vol_index, roi))
+        return roi
+
+    # predict the labels of the three stages of a volume from its cubes
+    def predict_cubes(self, volumes, vol_dim, run_starts, culled_starts, vol_index):
+        '''
+        run the cascade on the cubes of a volume and compose the labels of every stage
+        :param volumes: normalized images and T1ce volumes
+        :param vol_dim: shape of the volumes
+        :param run_starts: starts of the cubes fed to the network
+        :param culled_starts: starts of the cubes predicted as background without running the network
+        :param vol_index: index of the volume in the progress messages
+        :return: WT, TC and NET label volumes, report of the cubes run by stages 2 and 3 (gated inference)
+        '''
+        compositors = [CubeCompositor(vol_dim, self.inputI_size, self.ovlp_ita, self.output_chn) for _ in range(3)]
+        for compositor in compositors:
+            compositor.add_background(culled_starts)
+        self.sess.graph.finalize()
+
+        if not self.gated_inference:
+            # the cubes go through the network test_batch_size at a time (the last batch may be smaller)
+            c = 0
+            for cube_starts, (cube2test, cube2test_2) in cube_batches(volumes, self.inputI_size, self.ovlp_ita,
+                                                                      self.test_batch_size, starts=run_starts):
+                if c % 20 < self.test_batch_size:
+                    print("predict %s MRI volume %s cube" % (vol_index, c))
+                cube_labels = self.sess.run(
+                    [self.stage1_pred_label, self.stage2_pred_label, self.stage3_pred_label],
+                    feed_dict={
+                        self.stage1_inputI: cube2test,
+                        self.stage2_inputI: cube2test_2,
+                        self.stage3_inputI: cube2test_2})
+                for compositor, cube_label in zip(compositors, cube_labels):
+                    compositor.add(cube_starts, cube_label)
+                c += len(cube_starts)
+            return [compositor.label() for compositor in compositors] + [None]
+
+        # pass one: stage 1 alone, the logits of the cubes with whole tumor voxels are kept (float16) for pass two
+        stage1_logits = {}
+        c = 0
+        for cube_starts, (cube2test,) in cube_batches(volumes[0:1], self.inputI_size, self.ovlp_ita,
+                                                      self.test_batch_size, starts=run_starts):
+            if c % 20 < self.test_batch_size:
+                print("predict %s MRI volume %s cube (stage 1)" % (vol_index, c))
+            cube_label, cube_logits = self.sess.run([self.stage1_pred_label, self.stage1_pred_prob],
+                                                    feed_dict={self.stage1_inputI: cube2test})
+            compositors[0].add(cube_starts, cube_label)
+            for start, label, logits in zip(cube_starts, cube_label, cube_logits):
+                if label.any():
+                    stage1_logits[start] = logits.astype("float16")
+            c += len(cube_starts)
+        composed_WT = compositors[0].label()
+
+        # pass two: stages 2 and 3 on the cubes within gate_margin of the whole tumor, background elsewhere
+        wt_integral = integral_volume(composed_WT > 0)
+        gated_starts = []
+        for start in run_starts:
+            box_start = [max(s - self.gate_margin, 0) for s in start]
+            box_end = [min(s + self.inputI_size + self.gate_margin, d) for s, d in zip(start, vol_dim)]
+            if box_sum(wt_integral, box_start, box_end) > 0:
+                gated_starts.append(start)
+            else:
+                compositors[1].add_background([start])
+                compositors[2].add_background([start])
+        cached_starts = [start for start in gated_starts if start in stage1_logits]
+        uncached_starts = [start for start in gated_starts if start not in stage1_logits]
+        # the cached stage 1 logits are fed in place of stage 1
+        for cube_starts, (cube2test_2,) in cube_batches(volumes[1:2], self.inputI_size, self.ovlp_ita,
+                                                        self.test_batch_size, starts=cached_starts):
+            cube_logits = np.stack([stage1_logits.pop(start) for start in cube_starts]).astype("float32")
+            cube_labels = self.sess.run(
+                [self.stage2_pred_label, self.stage3_pred_label],
+                feed_dict={
+                    self.stage1_pred_prob: cube_logits,
+                    self.stage2_inputI: cube2test_2,
+                    self.stage3_inputI: cube2test_2})
+            for compositor, cube_label in zip(compositors[1:], cube_labels):
+                compositor.add(cube_starts, cube_label)
+        # cubes near the whole tumor without whole tumor voxels of their own (logits not kept): stage 1 runs again
+        for cube_starts, (cube2test, cube2test_2) in cube_batches(volumes, self.inputI_size, self.ovlp_ita,
+                                                                  self.test_batch_size, starts=uncached_starts):
+            cube_labels = self.sess.run(
+                [self.stage2_pred_label, self.stage3_pred_label],
+                feed_dict={
+                    self.stage1_inputI: cube2test,
+                    self.stage2_inputI: cube2test_2,
+                    self.stage3_inputI: cube2test_2})
+            for compositor, cube_label in zip(compositors[1:], cube_labels):
+                compositor.add(cube_starts, cube_label)
+        saved = 1.0 - len(gated_starts) / max(len(run_starts), 1)
+        stage_log = "stages 2/3 run on %d of %d cubes (%d with cached stage 1 logits), %.1f%% of the cubes saved" % (
+            len(gated_starts), len(run_starts), len(cached_starts), 100 * saved)
+        return [composed_WT, compositors[1].label(), compositors[2].label(), stage_log]
+
     # test function for cross validation
     def test4crsv(self):
         init_op = tf.global_variables_initializer()
         self.sess.run(init_op)
         print("load checkpoint from:", self.chkpoint_dir, self.step)
         start_time = time.time()
-        if self.load_chkpoint(self.chkpoint_dir, self.step):
+        if self.saver is None:
+            print(" [*] frozen graph", self.frozen_graph)
+        elif self.load_chkpoint(self.chkpoint_dir, self.step):
             print(" [*] load succeed")
         else:
             print(" [!] load failed...")
@@ -730,7 +1048,9 @@ class CascadedModel(object):
         self.sess.run(init_op)
         print("load checkpoint from", self.chkpoint_dir, self.step)
         start_time = time.time()
-        if self.load_chkpoint(self.chkpoint_dir, self.step):
+        if self.saver is None:
+            print(" [*] frozen graph", self.frozen_graph)
+        elif self.load_chkpoint(self.chkpoint_dir, self.step):
             print(" [*] load succeed")
         else:
             print(" [!] load failed...")
@@ -741,7 +1061,7 @@ class CascadedModel(object):
 
     # save checkpoint file
 
-    def save_chkpoint(self, checkpoint_dir, model_name, step):
+    def save_chkpoint(self, checkpoint_dir, model_name, step, sampler_state=None):
         model_dir = "%s_%s_%s" % (self.batch_size, self.outputI_size, step)
         checkpoint_dir = os.path.join(checkpoint_dir, model_dir)
 
@@ -754,6 +1074,12 @@ class CascadedModel(object):
                 checkpoint_dir,
                 model_name),
             global_step=step)
+        # position of the data stream, to resume the training from this checkpoint
+        if sampler_state is not None:
+            state_path = os.path.join(checkpoint_dir, "sampler_state.json")
+            with open(state_path + ".tmp", "w") as f:
+                json.dump(sampler_state, f)
+            os.replace(state_path + ".tmp", state_path)
 
     # load checkpoint file
     def load_chkpoint(self, checkpoint_dir, step=-1):
@@ -763,11 +1089,16 @@ class CascadedModel(object):
         checkpoint_dir = os.path.join(checkpoint_dir, model_dir)
         print(" [*] load checkpoint from", str(checkpoint_dir))
         ckpt = tf.train.get_checkpoint_state(checkpoint_dir)
+        self.sampler_state = None
         if ckpt and ckpt.model_checkpoint_path:
             ckpt_name = os.path.basename(ckpt.model_checkpoint_path)
             self.saver.restore(
                 self.sess, os.path.join(
                     checkpoint_dir, ckpt_name))
+            state_path = os.path.join(checkpoint_dir, "sampler_state.json")
+            if os.path.exists(state_path):
+                with open(state_path, "r") as f:
+                    self.sampler_state = json.load(f)
             return True
         else:
             return False
@@ -0,0 +1,229 @@
+from __future__ import division
+import os
+import sys
+import json
+import time
+import struct
+import zlib
+import numpy as np
+
+# every record: magic, length of the JSON header, header, arrays one after another (sizes in the header)
+RECORD_MAGIC = b"BRATSREC"
+RECORD_PREFIX = struct.Struct("<8sQ")
+# large buffered reads and writes, a shard is read from the beginning to the end
+SHARD_BUFFER = 16 * 2 ** 20
+# label codes of the records are already bit-packed (see stage_label_lut)
+CODE_LUT = np.arange(256, dtype="uint8")
+
+
+def write_record(f, header, arrays):
+    '''
+    append a record to an open shard
+    :param f: shard file opened in binary mode
+    :param header: JSON-serializable dict
+    :param arrays: list of (name, ndarray)
+    :return: number of bytes written
+    '''
+    header = dict(header)
+    header["arrays"] = []
+    payload = []
+    for name, array in arrays:
+        array = np.ascontiguousarray(array)
+        data = array.tobytes()
+        header["arrays"].append({"name": name, "dtype": array.dtype.str, "shape": list(array.shape),
+                                 "nbytes": len(data), "crc": zlib.crc32(data) & 0xffffffff})
+        payload.append(data)
+    header_bytes = json.dumps(header).encode("utf-8")
+    f.write(RECORD_PREFIX.pack(RECORD_MAGIC, len(header_bytes)))
+    f.write(header_bytes)
+    for data in payload:
+        f.write(data)
+    return RECORD_PREFIX.size + len(header_bytes) + sum(len(data) for data in payload)
+
+
+def read_record(f, check_crc=False):
+    '''
+    read the next record of a shard
+    :return: header dict and dict name -> ndarray, None at the end of the shard
+    '''
+    prefix = f.read(RECORD_PREFIX.size)
+    if not prefix:
+        return None
+    if len(prefix) != RECORD_PREFIX.size:
+        raise Exception("truncated record in %s" % f.name)
+    magic, header_len = RECORD_PREFIX.unpack(prefix)
+    if magic != RECORD_MAGIC:
+        raise Exception("not a record file: %s" % f.name)
+    header = json.loads(f.read(header_len).decode("utf-8"))
+    arrays = {}
+    for spec in header.pop("arrays"):
+        data = f.read(spec["nbytes"])
+        if len(data) != spec["nbytes"]:
+            raise Exception("truncated record in %s" % f.name)
+        if check_crc and zlib.crc32(data) & 0xffffffff != spec["crc"]:
+            raise Exception("corrupted array %s of record %s" % (spec["name"], header.get("name")))
+        arrays[spec["name"]] = np.frombuffer(data, dtype=spec["dtype"]).reshape(spec["shape"])
+    return header, arrays
+
+
+class RecordWriter(object):
+    '''
+    writes the records of a dataset into num_shards shard files (patient k goes to shard k % num_shards) and
+    an index.json with the header of every record
+    '''
+
+    def __init__(self, record_dir, num_shards, prefix="train"):
+        self.record_dir = record_dir
+        os.makedirs(record_dir, exist_ok=True)
+        self.shard_names = ["%s-%05d-of-%05d.rec" % (prefix, k, num_shards) for k in range(num_shards)]
+        # written under a temporary name, renamed by close()
+        self.shards = [open(os.path.join(record_dir, name + ".tmp"), "wb", buffering=SHARD_BUFFER)
+                       for name in self.shard_names]
+        self.index = []
+
+    def write(self, header, arrays):
+        shard = len(self.index) % len(self.shards)
+        nbytes = write_record(self.shards[shard], header, arrays)
+        self.index.append(dict(header, shard=self.shard_names[shard], nbytes=nbytes))
+
+    def close(self):
+        for name, f in zip(self.shard_names, self.shards):
+            f.close()
+            os.replace(os.path.join(self.record_dir, name + ".tmp"), os.path.join(self.record_dir, name))
+        tmp_path = os.path.join(self.record_dir, "index.json.tmp")
+        with open(tmp_path, "w") as f:
+            json.dump({"shards": self.shard_names, "records": self.index}, f)
+        os.replace(tmp_path, os.path.join(self.record_dir, "index.json"))
+
+
+class RecordReader(object):
+    '''
+    endless stream of the records of a dataset: the shards are read sequentially in a new random order every
+    epoch and the records go through a shuffle buffer of shuffle_buffer patients
+    '''
+
+    def __init__(self, record_dir, shuffle_buffer=8, seed=1, check_crc=False):
+        self.record_dir = record_dir
+        with open(os.path.join(record_dir, "index.json"), "r") as f:
+            index = json.load(f)
+        self.shards = index["shards"]
+        self.records = index["records"]
+        self.shuffle_buffer = max(1, shuffle_buffer)
+        self.check_crc = check_crc
+        self.rng = np.random.RandomState(seed)
+        self.worker_id = 0
+        self.num_workers = 1
+        self._stream = None
+
+    def set_worker(self, worker_id, num_workers):
+        '''
+        restrict the reader to a part of the dataset, the loader workers then read different shards
+        (different records when there are fewer shards than workers)
+        '''
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.rng.seed((self.rng.randint(2 ** 31) + worker_id) % 2 ** 32)
+        self._stream = None
+
+    def _shard_records(self):
+        while True:
+            if len(self.shards) >= self.num_workers:
+                shards = self.shards[self.worker_id::self.num_workers]
+            else:
+                shards = self.shards
+            for shard in self.rng.permutation(shards):
+                with open(os.path.join(self.record_dir, shard), "rb", buffering=SHARD_BUFFER) as f:
+                    position = 0
+                    while True:
+                        record = read_record(f, self.check_crc)
+                        if record is None:
+                            break
+                        if len(self.shards) >= self.num_workers or position % self.num_workers == self.worker_id:
+                            yield record
+                        position += 1
+
+    def _shuffled(self):
+        buffer = []
+        for record in self._shard_records():
+            if len(buffer) < self.shuffle_buffer:
+                buffer.append(record)
+                continue
+            k = self.rng.randint(len(buffer))
+            yield buffer[k]
+            buffer[k] = record
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._stream is None:
+            self._stream = self._shuffled()
+        return next(self._stream)
+
+    def next(self):
+        return self.__next__()
+
+
+def export_records(generator, record_dir, num_shards):
+    '''
+    write the patients of a BatchGenerator as records: the brain region of the input modalities and T1ce
+    (int16) and the bit-packed stage labels (uint8), with the normalization statistics, the intensity CDFs
+    and the tumor index of the patient (coordinates in the stored box)
+    :param generator: BatchGenerator of the dataset
+    :param record_dir: output directory
+    :param num_shards: number of shard files
+    '''
+    from utils import Preprocessing, enlarged_box, foreground_coords
+
+    start_time = time.time()
+    writer = RecordWriter(record_dir, num_shards)
+    for j, single_file in enumerate(generator.file_list):
+        src_path = single_file["path"]
+        img_array, img_array2, stage1_label, stage2_label, stage3_label, affine = \
+            generator.load_volumes_label(src_path, True)
+        img_list = [img_array[..., c] for c in range(img_array.shape[-1])]
+        info = generator._volume_info(j, img_list, img_array2[..., 0])
+        regions = info["regions"]
+        # the stored box is the brain region, enlarged to hold at least one patch
+        box = enlarged_box(regions, img_array2.shape[:3], generator.crop_extent)
+        crop = tuple(slice(start, end) for start, end in box)
+        images = np.concatenate([img_array[crop], img_array2[crop]], axis=-1)
+        codes = (stage1_label | (stage2_label << 1) | (stage3_label << 2)).astype("uint8")[crop]
+        fg_coords, fg_counts = foreground_coords(codes)
+        cdf = np.stack([Preprocessing.intensity_cdf(images[..., c]) for c in range(images.shape[-1])])
+        header = {"index": j, "name": os.path.basename(src_path), "category": single_file["category"],
+                  "shape": list(img_array2.shape[:3]), "box": [int(v) for b in box for v in b],
+                  "region": [int(r) for r in regions], "affine": np.asarray(affine).tolist(),
+                  "stats": info["stats"].tolist(), "cdf": cdf.tolist(),
+                  "modalities": list(generator.input_modalities)}
+        arrays = [("images", np.clip(np.round(images), -32768, 32767).astype("int16")),
+                  ("codes", codes),
+                  ("fg_coords", fg_coords),
+                  ("fg_counts", fg_counts)]
+        writer.write(header, arrays)
+        print("[%d/%d] %s" % (j + 1, generator.total_num, src_path))
+    writer.close()
+    print("records written to %s (%.1fs)" % (record_dir, time.time() - start_time))
+
+
+if __name__ == "__main__":
+    # python records.py <record_dir> [num_shards], the dataset and the modalities are read from parameters.ini
+    from utils import load_train_ini, BatchGenerator
+
+    param_sets = load_train_ini("parameters.ini")
+    param_set = param_sets[0]
+    export_generator = BatchGenerator(
+        batch_size=1,
+        shuffle=False,
+        seed=1,
+        volume_path=param_set['traindata_dir'],
+        modalities=param_set['inputI_chn'],
+        resize_r=param_set['resize_r'],
+        rename_map=param_set['rename_map'],
+        patch_dim=param_set['outputI_size'],
+        augmentation=None,
+        cache_dir=param_set['cache_dir'],
+        cache_format=param_set['cache_format'],
+        chunk_codec=param_set['chunk_codec'],
+        manifest_dir=param_set['manifest_dir'])
+    export_records(export_generator, sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 16)
@@ -9,7 +9,16 @@ from scipy.ndimage import measurements
 import tensorflow as tf
 from glob import glob
 import re
+import json
+import hashlib
+import multiprocessing
+import threading
+import fcntl
+import traceback
+from queue import Empty
 import SimpleITK as sitk
+from records import RecordReader, CODE_LUT
+from chunkstore import ChunkedVolume, write_chunked
 import random
 from keras_preprocessing.image import *
 import cv2 as cv
@@ -17,7 +26,71 @@ import colorsys
 from skimage.measure import find_contours
 import matplotlib.pyplot as plt
 from matplotlib.patches import Polygon
-from collections import Counter
+from collections import Counter, OrderedDict
+
+
+# modality schema of the BraTS files, order of the sequences [seg, flair, T1, T1ce, T2]
+MODALITY_SCHEMA = {"seg": 0, "flair": 1, "t1": 2, "t1ce": 3, "t2": 4}
+# network input modalities for the different input channel numbers
+MODALITY_SELECTION = {4: ("flair", "t1", "t1ce", "t2"),
+                      3: ("flair", "t1ce", "t2"),
+                      2: ("flair", "t2"),
+                      1: ("flair",)}
+# input modality of stage 2 and stage 3
+AUX_MODALITY = "t1ce"
+MODALITY_SPLIT = re.compile(r'[\-\_\.]+')
+
+
+def parse_modality(nii_path):
+    '''
+    get the modality from a file name like BraTS19_XXX_X_X_flair.nii.gz
+    '''
+    modality = MODALITY_SPLIT.split(os.path.basename(nii_path))[-3]
+    assert modality in MODALITY_SCHEMA
+    return modality
+
+
+def dataset_key(volume_path):
+    '''
+    name of a dataset in the volume cache, the shared volume pool and the manifest directory, so that train
+    and test sets never collide
+    :return: directory name of volume_path and a hash of its absolute path
+    '''
+    path_hash = hashlib.md5(os.path.abspath(volume_path).encode("utf-8")).hexdigest()[:8]
+    return os.path.basename(os.path.normpath(volume_path)) + "_" + path_hash
+
+
+def modality_spec(modalities):
+    '''
+    modalities needed for a number of input channels
+    :param modalities: input channel number
+    :return: input modalities of the network, all the modalities to read (without the GT)
+    '''
+    input_modalities = MODALITY_SELECTION.get(modalities, MODALITY_SELECTION[1])
+    required_modalities = tuple(sorted(set(input_modalities + (AUX_MODALITY,)), key=MODALITY_SCHEMA.get))
+    return input_modalities, required_modalities
+
+
+def stage_label_lut(rename_map):
+    '''
+    lookup table from the raw GT values to the bit-packed labels of the cascaded stages:
+    bit 0 whole tumor, bit 1 tumor core (1, 4), bit 2 necrotic (1)
+    :param rename_map: label values, the first one is the background
+    :return: uint8 table of 256 entries
+    '''
+    lut = np.zeros(256, dtype='uint8')
+    for value in rename_map[1:]:
+        lut[value] |= 1
+    lut[[1, 4]] |= 2
+    lut[1] |= 4
+    return lut
+
+
+def unpack_stage_labels(codes):
+    '''
+    binary uint8 labels of the three stages (WT, TC, NET) from the bit-packed labels
+    '''
+    return tuple((codes >> k) & 1 for k in range(3))
 
 
 # construct a iterator for batch generation
@@ -36,12 +109,52 @@ class BatchGenerator(Iterator):
             resize_r,
             rename_map,
             patch_dim,
-            augmentation):
+            augmentation,
+            cache_dir=None,
+            cache_format="npy",
+            chunk_codec="zlib",
+            manifest_dir=None,
+            shm_dir=None,
+            shm_pool_mb=0,
+            hist_match=False,
+            fg_sample_ratio=0,
+            patches_per_volume=1,
+            pool_interleave=1,
+            pool_size_mb=0,
+            record_dir=None,
+            shuffle_buffer=8):
         self.batch_size = batch_size
         self.volume_path = volume_path
         self.modalities = modalities
+        # modalities to read: the network inputs and T1ce for stage 2/3
+        self.input_modalities, self.required_modalities = modality_spec(modalities)
         self.resize_ratio = resize_r
         self.rename_map = rename_map
+        # bit-packed stage labels of every raw GT value
+        self.label_lut = stage_label_lut(rename_map)
+        # sequential stream of the patients from the record shards (see records.py) instead of the volume files
+        self.records = RecordReader(record_dir, shuffle_buffer, seed) if record_dir else None
+        # decompressed volume cache, disabled without a cache directory
+        if cache_dir and self.records is None:
+            self.cache = VolumeCache(cache_dir, volume_path, cache_format, chunk_codec)
+        else:
+            self.cache = None
+        # decoded volumes shared by all the processes of the node, limited by its size in bytes
+        if shm_dir and shm_pool_mb > 0 and self.records is None:
+            self.shm_pool = SharedVolumePool(shm_dir, volume_path, shm_pool_mb * 2 ** 20)
+        else:
+            self.shm_pool = None
+        # dataset manifest, saved in its own directory (next to the cache without one)
+        if self.records is None:
+            if manifest_dir:
+                manifest_path = DatasetManifest.default_path(manifest_dir, volume_path)
+            elif self.cache is not None:
+                manifest_path = os.path.join(self.cache.root, "manifest.json")
+            else:
+                manifest_path = None
+            self.manifest = DatasetManifest(volume_path, manifest_path)
+        else:
+            self.manifest = None
         self.file_list = self._get_img_info()
         self.total_num = len(self.file_list)
         self.patch_dim = patch_dim
@@ -49,6 +162,18 @@ class BatchGenerator(Iterator):
         self.augmentation = augmentation
         self.image_shape = (patch_dim, patch_dim, patch_dim) + (modalities,)
         self.label_shape = (patch_dim, patch_dim, patch_dim)
+        # histogram matching augmentation against the intensity CDFs of a random partner patient
+        self.hist_match = hist_match
+        # brain region, normalization statistics and tumor index of the patients
+        self.volume_info = {}
+        # fraction of the patches centered on a tumor voxel, the others are uniform in the brain region
+        self.fg_sample_ratio = fg_sample_ratio
+        # several patches from every loaded patient, kept in a pool limited by its size in bytes
+        self.patches_per_volume = patches_per_volume
+        self.pool_interleave = pool_interleave
+        self.pool = PatientPool(pool_size_mb * 2 ** 20) if patches_per_volume > 1 else None
+        self.pool_cursor = 0
+        self.intensity_cdfs = self._get_intensity_cdfs() if hist_match else None
         super(
             BatchGenerator,
             self).__init__(
@@ -57,183 +182,527 @@ class BatchGenerator(Iterator):
             shuffle=shuffle,
             seed=seed)
 
+    @property
+    def crop_extent(self):
+        # size of the crop of the original volume resized to a patch
+        if self.resize_ratio == 1:
+            return self.patch_dim
+        return int(round(self.patch_dim / self.resize_ratio))
+
     def _get_img_info(self):
         '''
-        this function read all files of specific directory, get the path list
+        get the path list of all the patients from the dataset manifest (or the record index)
         :return:path list of all the volume files
         '''
-        file_list = []
-        categories = os.listdir(self.volume_path)
-        for category in categories:
-            category_path = os.path.join(self.volume_path, category)
-            dir_list = os.listdir(category_path)
-            for dire in dir_list:
-                dire_lower = dire.lower()
-                if not dire_lower.startswith('brats'):
-                    raise Exception("volume file exception!")
-                file_abs_path = os.path.join(category_path, dire)
-                single_file = {"path": file_abs_path, "category": category}
-                file_list.append(single_file)
-
-        return file_list
-
-    def _get_batches_of_transformed_samples(self, index_array):
-
-        batch_x = np.zeros(
-            (len(index_array),
-             ) + self.image_shape,
-            dtype='float32')
-        batch_x2 = np.zeros(
-            (len(index_array),
-             ) + self.label_shape+(1,),
-            dtype='float32')
-        batch_y = np.zeros(
-            (len(index_array),
-             ) + self.label_shape,
-            dtype='int32')
-        batch_y_stage2 = np.zeros(
-            (len(index_array),
-             ) + self.label_shape,
-            dtype='int32')
-        batch_y_stage3 = np.zeros(
-            (len(index_array),
-             ) + self.label_shape,
-            dtype='int32')
+        if self.records is not None:
+            return [{"path": r["name"], "category": r["category"]} for r in self.records.records]
+        return [{"path": p["path"], "category": p["category"]} for p in self.manifest.patients]
+
+    def build_cache(self):
+        '''
+        decompress all the volumes of the dataset into the cache once, the following loads are memory-mapped.
+        The brain regions and intensity statistics missing from the manifest are computed on the way, also
+        without a cache: the loader workers cannot save the manifest, so they only read them.
+        '''
+        if self.manifest is None:
+            return
+        start_time = time.time()
+        for j, single_file in enumerate(self.file_list):
+            entry = self.manifest.get(single_file["path"])
+            complete = entry["brain_region"] is not None and all(
+                modality in entry["stats"] for modality in self.input_modalities + (AUX_MODALITY,))
+            if self.cache is not None:
+                volume_dict, seg_dict = self._required_volumes(single_file["path"])
+                data_dicts = [volume_dict[m] for m in self.required_modalities]
+                for data_dict in data_dicts + ([seg_dict] if seg_dict["mod"] == "seg" else []):
+                    self._load_nii(single_file["path"], data_dict)
+            if not complete:
+                img_list, img_t1ce, _, _ = self._load_modalities(single_file["path"])
+                self._volume_info(j, img_list, img_t1ce)
+        self.manifest.save()
+        if self.cache is not None:
+            print("volume cache ready: %s (%.1fs)" % (self.cache.root, time.time() - start_time))
+        else:
+            print("dataset manifest ready: %s (%.1fs)" % (self.manifest.manifest_path, time.time() - start_time))
+
+    def index_array_for_batch(self, batch_index):
+        '''
+        patient indices of a batch, a function of the batch number only so that every loader worker
+        can produce any batch of the stream. The patients left over by the last full batch of an epoch are
+        dropped (as drop_remainder in the tf.data pipeline), every batch fills all its rows.
+        :param batch_index: global batch number
+        :return: array of batch_size patient indices
+        '''
+        batches_per_epoch = self.n // self.batch_size
+        if batches_per_epoch == 0:
+            raise Exception("batch size %d is larger than the %d patients of %s" % (
+                self.batch_size, self.n, self.volume_path))
+        epoch, k = divmod(batch_index, batches_per_epoch)
+        if self.shuffle:
+            order = np.random.RandomState((self.seed + epoch) % 2 ** 32).permutation(self.n)
+        else:
+            order = np.arange(self.n)
+        return order[k * self.batch_size:(k + 1) * self.batch_size]
+
+    def seed_batch(self, batch_index):
+        '''
+        seed all the random sources used by a batch (anchor, histogram matching partner, augmentation)
+        :param batch_index: global batch number
+        '''
+        batch_seed = (self.seed + batch_index) % 2 ** 32
+        np.random.seed(batch_seed)
+        random.seed(batch_seed)
+        if self.augmentation and hasattr(self.augmentation, "reseed"):
+            self.augmentation.reseed(batch_seed)
+
+    def stream_caveats(self, input_mode="feed"):
+        '''
+        parts of the data stream that are not a function of the batch number: a resumed training only
+        continues the exact stream of the checkpoint without them
+        :param input_mode: feed (PrefetchLoader) or dataset (tf.data pipeline)
+        :return: list of descriptions, empty when the stream is exactly restored
+        '''
+        caveats = []
+        if input_mode == "dataset":
+            caveats.append("the tf.data pipeline restarts its box stream and its shuffle (seeded with seed + batch "
+                           "number), the patient order differs from the original run")
+        if self.records is not None:
+            caveats.append("the record readers restart their shard order and shuffle buffer, the stream also depends "
+                           "on the number of loader workers")
+        if self.pool is not None:
+            caveats.append("the patient pools (patches_per_volume > 1) start empty in every loader worker, the patches "
+                           "also depend on the number of loader workers")
+        return caveats
+
+    def sampler_state(self, counter, epoch, batch_index, input_mode="feed"):
+        '''
+        position of the data stream saved with a checkpoint. The batches are seeded by their number
+        (seed_batch), so the batch number also restores the NumPy and augmentation random states, unless
+        stream_caveats lists parts of the stream that are not restored.
+        :param counter: training step counter
+        :param epoch: next iteration of the training loop
+        :param batch_index: number of the next batch
+        :param input_mode: feed or dataset
+        :return: JSON-serializable dict
+        '''
+        return {"counter": int(counter), "epoch": int(epoch), "batch_index": int(batch_index),
+                "seed": self.seed, "batch_size": self.batch_size, "num_patients": self.n,
+                "patches_per_volume": self.patches_per_volume, "input_mode": input_mode,
+                "exact": not self.stream_caveats(input_mode)}
+
+    def check_sampler_state(self, state, input_mode="feed"):
+        # the stream of a checkpoint can only be continued with the same sampler
+        for key, value in (("seed", self.seed), ("batch_size", self.batch_size), ("num_patients", self.n),
+                           ("patches_per_volume", self.patches_per_volume)):
+            if state[key] != value:
+                print(" [!] sampler %s changed since the checkpoint (%s -> %s), the data stream differs"
+                      % (key, state[key], value))
+        # only the batch number is restored
+        for caveat in self.stream_caveats(input_mode):
+            print(" [!] WARNING: the resumed data stream is not the one of the original run: %s" % caveat)
+
+    def set_worker(self, worker_id, num_workers):
+        '''
+        called in every loader worker, the workers stream different parts of the records
+        '''
+        if self.records is not None:
+            self.records.set_worker(worker_id, num_workers)
+
+    def get_batch(self, batch_index, out=None):
+        # deterministic batch of the stream, whichever process produces it
+        self.seed_batch(batch_index)
+        return self._get_batches_of_transformed_samples(self.index_array_for_batch(batch_index), out)
+
+    def _get_intensity_cdfs(self):
+        '''
+        precompute the intensity CDFs of every patient (input channels and T1ce) for histogram matching
+        :return: list of arrays (modalities + 1, n_quantiles)
+        '''
+        if self.records is not None:
+            return [np.array(r["cdf"], dtype="float32") for r in self.records.records]
+        start_time = time.time()
+        cdf_list = []
+        for single_file in self.file_list:
+            src_path = single_file["path"]
+
+            def compute():
+                img_list, img_t1ce, _, _ = self._load_modalities(src_path)
+                return {"cdf": np.stack([Preprocessing.intensity_cdf(np.asarray(img))
+                                         for img in img_list + [img_t1ce]])}
+
+            if self.cache is not None:
+                volume_dict, _ = self._required_volumes(src_path)
+                # the rows follow the input modalities, not only their number
+                cdf_list.append(self.cache.derived(src_path, "cdf_%d" % self.modalities,
+                                                   [volume_dict[m]["path"] for m in self.required_modalities],
+                                                   compute,
+                                                   {"modalities": list(self.input_modalities) + [AUX_MODALITY]})["cdf"])
+            else:
+                cdf_list.append(compute()["cdf"])
+        print("intensity CDFs ready (%.1fs)" % (time.time() - start_time))
+        return cdf_list
+
+    def _load_nii(self, src_path, data_dict):
+        '''
+        load a single .nii.gz file, through the shared volume pool and the volume cache if they are enabled
+        :return: volume data and the affine
+        '''
+        if self.shm_pool is not None:
+            return self.shm_pool.load(src_path, data_dict["mod"], data_dict["path"],
+                                      lambda: self._load_source(src_path, data_dict))
+        return self._load_source(src_path, data_dict)
+
+    def _load_source(self, src_path, data_dict):
+        if self.cache is not None:
+            return self.cache.load(src_path, data_dict["mod"], data_dict["path"])
+        volume = nib.load(data_dict["path"])
+        return volume.get_data().copy(), volume.affine
+
+    def batch_specs(self):
+        '''
+        :return: shape and dtype of the five arrays of a batch (image, T1ce, labels of the three stages)
+        '''
+        return [((self.batch_size,) + self.image_shape, "float32"),
+                ((self.batch_size,) + self.label_shape + (1,), "float32"),
+                ((self.batch_size,) + self.label_shape, "int32"),
+                ((self.batch_size,) + self.label_shape, "int32"),
+                ((self.batch_size,) + self.label_shape, "int32")]
+
+    def _get_batches_of_transformed_samples(self, index_array, out=None):
+        '''
+        :param index_array: patient indices of the batch
+        :param out: preallocated batch arrays (see batch_specs) the patches are written into
+        :return: batch arrays
+        '''
+        if out is None:
+            out = [np.empty((len(index_array),) + shape[1:], dtype=dtype) for shape, dtype in self.batch_specs()]
         for i, j in enumerate(index_array):
-            # data directory of a patient
-            single_dir_path = self.file_list[j]["path"]
-
-            img_data, img_data2, stage1_label_data, stage2_label, \
-            stage3_label, _ = self.load_volumes_label(single_dir_path, True)
-
-            rand_num = np.random.randint(self.total_num - 1, size=self.total_num)
-            matching_index = rand_num[0] if rand_num[0] != j else rand_num[-1]
-            # ready for histogram matching
-            img_data_matching, img_data_matching2, _, _, _, _ = self.load_volumes_label(
-                self.file_list[matching_index]["path"], True)
-            img_data_matching_cast = img_data_matching.astype("float32")
-            img_data_matching_cast2 = img_data_matching2.astype("float32")
-
-            # data augmentation
-            volume_list = [img_data[...,0], img_data[...,1], np.squeeze(img_data2, axis=-1),
-                           stage1_label_data, stage2_label, stage3_label]
-            img_data_0, img_data_1, img_data2, stage1_label_data, \
-            stage2_label, stage3_label = self.data_augment_volume(*volume_list,
-                                                                 augmentation=self.augmentation)
-
-            img_data = np.stack((img_data_0,img_data_1), axis=-1)
-            img_data2 = np.expand_dims(img_data2, axis=-1)
-
-            # reduce background region
-            regions = get_brain_region(np.squeeze(img_data2, axis=-1))
-            img_data = img_data[regions[0]:regions[1], regions[2]:regions[3], regions[4]:regions[5], :]
-            img_data2 = img_data2[regions[0]:regions[1], regions[2]:regions[3], regions[4]:regions[5], :]
-            stage1_label_data = stage1_label_data[regions[0]:regions[1], regions[2]:regions[3], regions[4]:regions[5]]
-            stage2_label= stage2_label[regions[0]:regions[1], regions[2]:regions[3],
-                                   regions[4]:regions[5]]
-            stage3_label = stage3_label[regions[0]:regions[1], regions[2]:regions[3],
-                               regions[4]:regions[5]]
-
-            # test whether using the histogram matching data augmentation method.(deprecated)
-            augment = False
-            if augment:
-                # histogram matching data augmentation
-                img_hist_match = Preprocessing.hist_match(
-                    img_data.astype("float32"), img_data_matching_cast)
-
-                img_hist_match2 = Preprocessing.hist_match(img_data2.astype("float32"), img_data_matching_cast2)
-                # using B-spine interpolation for deformation (just like V-net did)
-                numcontrolpoints = 2
-                sigma = 15
+            entry = self._next_patient(j)
+            # the patch is normalized directly into its row of the batch
+            self._sample_patch(entry, out=[batch[i] for batch in out])
+        return tuple(out)
+
+    def _volume_info(self, j, img_list, img_t1ce):
+        '''
+        brain region and normalization statistics of a patient, computed once per volume
+        :return: dict with the regions and the (mean, std) of every input channel and of T1ce
+        '''
+        if j not in self.volume_info:
+            src_path = self.file_list[j]["path"]
+            regions = self.brain_region(src_path, img_t1ce)
+            brain = (slice(regions[0], regions[1]), slice(regions[2], regions[3]), slice(regions[4], regions[5]))
+            # intensity statistics of every modality are kept in the manifest
+            manifest_stats = dict(self.manifest.get(src_path)["stats"])
+            stats = []
+            for modality, img in zip(self.input_modalities + (AUX_MODALITY,), img_list + [img_t1ce]):
+                if modality not in manifest_stats:
+                    mean, std = Preprocessing.normalization_stats(img[brain])
+                    manifest_stats[modality] = [float(mean), float(std)]
+                stats.append(manifest_stats[modality])
+            self.manifest.update(src_path, stats=manifest_stats)
+            self.volume_info[j] = {"regions": regions, "stats": np.array(stats, dtype="float32")}
+        return self.volume_info[j]
+
+    def brain_region(self, src_path, img_t1ce):
+        '''
+        brain region of a patient (from T1ce), computed once and kept in the dataset manifest
+        :param src_path: directory path of a patient
+        :param img_t1ce: T1ce volume of the patient
+        :return: (min, max) indices of the three axes
+        '''
+        entry = self.manifest.get(src_path)
+        if entry is None:
+            return get_brain_region(np.asarray(img_t1ce))
+        if entry["brain_region"] is None:
+            self.manifest.update(src_path, brain_region=list(get_brain_region(np.asarray(img_t1ce))))
+        return tuple(entry["brain_region"])
+
+    def _foreground_index(self, entry):
+        '''
+        coordinates of the tumor voxels of a patient for the classes WT/TC/NET, computed once per patient
+        and kept next to the cached volume
+        :return: dict with the coordinates of all classes one after another (uint8 for BraTS) and the
+                 number of coordinates of every class
+        '''
+        info = entry["info"]
+        if "fg_index" not in info:
+            label = entry["label"]
+
+            def compute():
+                coords, counts = foreground_coords(entry["lut"][np.asarray(label, dtype="uint8")])
+                return {"coords": coords, "counts": counts}
+
+            src_path = self.file_list[entry["index"]]["path"]
+            if self.cache is not None:
+                _, seg_dict = self._required_volumes(src_path)
+                # the classes come from the label table (rename_map)
+                info["fg_index"] = self.cache.derived(src_path, "fg_index", [seg_dict["path"]], compute,
+                                                      {"label_lut": hashlib.md5(entry["lut"].tobytes()).hexdigest()})
             else:
-                img_hist_match = img_data
-                img_hist_match2 = img_data2
-
-            # resize
-            resize_dim = (np.array(stage1_label_data.shape) * self.resize_ratio).astype('int')
-            img_data_resize = resize(img_hist_match.astype("float32"), resize_dim, order=1, preserve_range=True)
-            img_data2_resize = resize(img_hist_match2.astype("float32"), resize_dim, order=1, preserve_range=True)
-
-            stage1_label_resize = resize(stage1_label_data, resize_dim, order=0, preserve_range=True)
-            stage2_label_resize = resize(stage2_label, resize_dim, order=0, preserve_range=True)
-            stage3_label_resize = resize(stage3_label, resize_dim, order=0, preserve_range=True)
-
-            img_data_cast = img_data_resize.astype("float32")
-            img_data_cast2 = img_data2_resize.astype("float32")
-
-            label_data_cast = stage1_label_resize.astype('int32')
-            stage2_label_cast = stage2_label_resize.astype("int32")
-            stage3_label_cast = stage3_label_resize.astype("int32")
-
-            # normalization
-            img_norm = Preprocessing.Normalization(img_data_cast, axis=(0, 1, 2))
-            img_norm2 = Preprocessing.Normalization(img_data_cast2)
-            # randomly select a box anchor
-            l, w, h = label_data_cast.shape
-            l_rand = np.arange(l - self.patch_dim)  # get a start point
-            w_rand = np.arange(w - self.patch_dim)
-            h_rand = np.arange(h - self.patch_dim)
-            np.random.shuffle(l_rand)  # shuffle the start point series
-            np.random.shuffle(w_rand)
-            np.random.shuffle(h_rand)
-
-            pos = np.array([l_rand[0], w_rand[0], h_rand[0]])  # get the start point
-            # crop the volume to get the same size for the network
-            img_temp = copy.deepcopy(img_norm[pos[0]:pos[0] +
-                                                   self.patch_dim, pos[1]:pos[1] +
-                                                   self.patch_dim, pos[2]:pos[2] +
-                                                   self.patch_dim, :])
-            img_temp2 = copy.deepcopy(img_norm2[pos[0]:pos[0] +
-                                                   self.patch_dim, pos[1]:pos[1] +
-                                                   self.patch_dim, pos[2]:pos[2] +
-                                                   self.patch_dim, :])
-
-            # crop the label just like the volume data
-            label_temp = copy.deepcopy(
-                label_data_cast[pos[0]:pos[0] + self.patch_dim, pos[1]:pos[1] + self.patch_dim, pos[2]:pos[2] + self.patch_dim])
-
-            stage2_label_temp = copy.deepcopy(stage2_label_cast[pos[0]:pos[0] + self.patch_dim, pos[1]:pos[1] + self.patch_dim, pos[2]:pos[2] + self.patch_dim])
-            stage3_label_temp = copy.deepcopy(stage3_label_cast[pos[0]:pos[0] + self.patch_dim, pos[1]:pos[1] + self.patch_dim, pos[2]:pos[2] + self.patch_dim])
-
-            # get the batch data
-            batch_x[i, :, :, :, :] = img_temp
-            batch_x2[i, :, :, :, :] = img_temp2
-            batch_y[i, :, :, :] = label_temp
-            batch_y_stage2[i,:,:,:] = stage2_label_temp
-            batch_y_stage3[i,:,:,:] = stage3_label_temp
-
-        return batch_x, batch_x2, batch_y, batch_y_stage2, batch_y_stage3
+                info["fg_index"] = compute()
+        return info["fg_index"]
+
+    def _sample_foreground_center(self, entry, rand=np.random):
+        '''
+        draw a tumor voxel as patch center, the class is chosen uniformly among the ones present
+        :param rand: random source (np.random or a RandomState)
+        :return: voxel coordinate, None when the patient has no tumor
+        '''
+        fg_index = self._foreground_index(entry)
+        counts = fg_index["counts"]
+        present = np.nonzero(counts)[0]
+        if len(present) == 0:
+            return None
+        c = present[rand.randint(len(present))]
+        offset = np.sum(counts[:c])
+        return fg_index["coords"][offset + rand.randint(counts[c])].astype("int")
+
+    def _prepare_patient(self, j):
+        '''
+        load a patient and everything computed once per volume
+        :param j: index of the patient
+        :return: dict of the patient, used by _sample_patch
+        '''
+        if self.records is not None:
+            return self._record_patient()
+        # data directory of a patient
+        single_dir_path = self.file_list[j]["path"]
+        img_list, img_t1ce, label, _ = self._load_modalities(single_dir_path)
+        info = self._volume_info(j, img_list, img_t1ce)
+        return {"index": j, "img_list": img_list, "img_t1ce": img_t1ce, "label": label, "lut": self.label_lut,
+                "info": info, "remaining": self.patches_per_volume, "anchors": set()}
+
+    def _record_patient(self):
+        '''
+        next patient of the record stream, the stored box replaces the whole volume
+        :return: dict of the patient, used by _sample_patch
+        '''
+        return self.box_entry(*self._record_box(*next(self.records)))
+
+    @staticmethod
+    def _record_box(header, arrays):
+        box = header["box"]
+        # brain region in the coordinates of the box
+        regions = np.array([header["region"][k] - box[k - k % 2] for k in range(6)], dtype="int64")
+        return (np.int64(header["index"]), arrays["images"], arrays["codes"], regions,
+                np.array(header["stats"], dtype="float32"), arrays["fg_coords"].astype("int32"),
+                arrays["fg_counts"])
+
+    def record_boxes(self):
+        '''
+        the record stream as patient boxes (see patient_box)
+        '''
+        for header, arrays in self.records:
+            yield self._record_box(header, arrays)
+
+    def patient_box(self, j):
+        '''
+        brain region of a patient (enlarged to hold a patch), the input of the tf.data pipeline
+        :param j: index of the patient
+        :return: index, images (int16, input modalities and T1ce), label codes, brain region in the box,
+                 normalization statistics, tumor coordinates and number of coordinates of every class
+        '''
+        j = int(j)
+        img_list, img_t1ce, label, _ = self._load_modalities(self.file_list[j]["path"])
+        info = self._volume_info(j, img_list, img_t1ce)
+        box = enlarged_box(info["regions"], img_t1ce.shape, self.crop_extent)
+        crop = tuple(slice(start, end) for start, end in box)
+        images = np.stack([np.asarray(img[crop]) for img in img_list + [img_t1ce]], axis=-1)
+        codes = self.label_lut[self._label_crop(label, crop)]
+        coords, counts = foreground_coords(codes)
+        regions = np.array([info["regions"][k] - box[k // 2][0] for k in range(6)], dtype="int64")
+        return (np.int64(j), np.clip(np.round(images), -32768, 32767).astype("int16"), codes, regions,
+                info["stats"], coords.astype("int32"), counts)
+
+    def box_entry(self, index, images, codes, regions, stats, fg_coords, fg_counts):
+        '''
+        patient dict of a box given by patient_box or the records
+        :return: dict of the patient, used by _sample_patch
+        '''
+        info = {"regions": tuple(int(r) for r in regions), "stats": stats,
+                "fg_index": {"coords": fg_coords, "counts": fg_counts}}
+        img_list = [images[..., c] for c in range(images.shape[-1] - 1)]
+        return {"index": int(index), "img_list": img_list, "img_t1ce": images[..., -1], "label": codes,
+                "lut": CODE_LUT, "info": info, "remaining": self.patches_per_volume, "anchors": set()}
+
+    def dataset_sample(self, sample_index, *box):
+        '''
+        patch of a patient box for the tf.data pipeline, seeded by the sample number only so that the
+        parallel map calls give the same stream
+        :param sample_index: global sample number
+        :param box: patient box (see patient_box)
+        :return: image patch, T1ce patch and the labels of the three stages (int32)
+        '''
+        rng = np.random.RandomState((self.seed + int(sample_index)) % 2 ** 32)
+        return tuple(self._sample_patch(self.box_entry(*box), rng))
+
+    def _next_patient(self, j):
+        '''
+        patient of the next patch. With patches_per_volume > 1 every loaded patient gives that many patches,
+        taken in turn from pool_interleave patients; the patient j is only loaded when a new one is needed.
+        '''
+        if self.pool is None:
+            return self._prepare_patient(j)
+        active = [entry for entry in self.pool.values() if entry["remaining"] > 0]
+        if len(active) < self.pool_interleave:
+            # the record stream gives a new patient every time
+            entry = self.pool.get(j) if self.records is None else None
+            if entry is None:
+                entry = self._prepare_patient(j)
+            elif entry["remaining"] <= 0:
+                # still in the pool, no need to load it again
+                entry["remaining"] = self.patches_per_volume
+                entry["anchors"] = set()
+            self.pool.put(entry["index"], entry)
+            return entry
+        self.pool_cursor = (self.pool_cursor + 1) % len(active)
+        return active[self.pool_cursor]
+
+    def _sample_patch(self, entry, rng=None, out=None):
+        '''
+        crop a random patch of a patient, only the patch region is resized and normalized
+        :param entry: patient prepared by _prepare_patient
+        :param rng: RandomState of the patch, the global random state (seeded by seed_batch) by default
+        :param out: arrays the image patch, T1ce patch and int32 labels are written into (a row of a batch)
+        :return: image patch, T1ce patch and the labels of the three stages
+        '''
+        rand = rng if rng is not None else np.random
+        j = entry["index"]
+        img_list = entry["img_list"]
+        img_t1ce = entry["img_t1ce"]
+        label = entry["label"]
+        info = entry["info"]
+        regions = info["regions"]
+
+        # randomly select a box anchor in the resized brain region and map it back to the original volume
+        extent = self.crop_extent
+        # several patches of the same patient should be distinct
+        for _ in range(10):
+            center = None
+            if self.fg_sample_ratio > 0 and rand.rand() < self.fg_sample_ratio:
+                # tumor-centered patch
+                center = self._sample_foreground_center(entry, rand)
+            starts = []
+            for axis in range(3):
+                if center is not None:
+                    start = center[axis] - extent // 2
+                else:
+                    resized_length = int((regions[2 * axis + 1] - regions[2 * axis]) * self.resize_ratio)
+                    anchor = rand.randint(max(resized_length - self.patch_dim, 1))
+                    start = regions[2 * axis] + int(anchor / self.resize_ratio)
+                starts.append(int(max(0, min(start, img_t1ce.shape[axis] - extent))))
+            if tuple(starts) not in entry["anchors"]:
+                break
+        entry["anchors"].add(tuple(starts))
+        entry["remaining"] -= 1
+        # the augmentation reads a margin around the patch
+        margin = self.augmentation.margin(extent) if self.augmentation else (0, 0, 0)
+        crop = tuple(slice(max(0, start - m), min(dim, start + extent + m))
+                     for start, m, dim in zip(starts, margin, img_t1ce.shape))
+        origin = tuple(start - c.start for start, c in zip(starts, crop))
+
+        # crop the volumes and the label before any other processing
+        channels = [np.asarray(img[crop], dtype="float32") for img in img_list + [img_t1ce]]
+        # stage label codes of the crop from the raw uint8 GT, one lookup-table pass
+        codes = entry["lut"][self._label_crop(label, crop)]
+
+        # normalization statistics of the whole volume, they follow the histogram matching of the channels
+        stats = info["stats"]
+        if self.hist_match:
+            # histogram matching data augmentation, only the CDFs of the partner are needed
+            matching_index = rand.randint(self.total_num - 1)
+            matching_index = matching_index + 1 if matching_index >= j else matching_index
+            source_cdf = self.intensity_cdfs[j]
+            template_cdf = self.intensity_cdfs[matching_index]
+            channels = [Preprocessing.hist_match_cdf(channel, source_cdf[c], template_cdf[c])
+                        for c, channel in enumerate(channels)]
+            stats = np.array([Preprocessing.matched_stats(stats[c], source_cdf[c], template_cdf[c])
+                              for c in range(len(channels))], dtype="float32")
+
+        # data augmentation, one sampled transform for all the channels and the label
+        if self.augmentation:
+            channels, codes = self.augmentation(channels, codes, origin, extent, rng)
+        else:
+            patch = tuple(slice(o, o + extent) for o in origin)
+            channels = [channel[patch] for channel in channels]
+            codes = codes[patch]
+        # resize the patch only, nothing to do for resize_r = 1
+        if extent != self.patch_dim:
+            resize_dim = (self.patch_dim,) * 3
+            channels = [resize(channel, resize_dim, order=1, preserve_range=True) for channel in channels]
+            codes = resize(codes, resize_dim, order=0, preserve_range=True, anti_aliasing=False).astype("uint8")
+
+        if out is None:
+            patch_shape = (self.patch_dim,) * 3
+            out = [np.empty(patch_shape + (len(channels) - 1,), dtype="float32"),
+                   np.empty(patch_shape + (1,), dtype="float32")] + \
+                  [np.empty(patch_shape, dtype="int32") for _ in range(3)]
+
+        # normalization with the statistics of the whole volume, written into the output arrays
+        for c, channel in enumerate(channels[:-1]):
+            Preprocessing.Normalization(channel, stats=stats[c], out=out[0][..., c])
+        Preprocessing.Normalization(channels[-1], stats=stats[-1], out=out[1][..., 0])
+        # stage labels from the bit-packed codes
+        for k in range(3):
+            np.bitwise_and(np.right_shift(codes, k), 1, out=out[2 + k])
+        return out
+
+    # load the selected modalities without any copy
+    def _load_modalities(self, src_path):
+        '''
+        get the input modalities, T1ce and the GT of a patient, memory-mapped when the cache is enabled
+        :param src_path: directory path of a patient
+        :return: list of the input volumes, T1ce volume, GT (None without GT) and the affine
+        '''
+        volume_dict, seg_dict = self._required_volumes(src_path)
+        if seg_dict["mod"] == "seg":
+            label, _ = self._load_nii(src_path, seg_dict)
+            # raw GT values (0, 1, 2, 4) are kept once as uint8, a chunked GT stays lazy (already uint8 in the
+            # cache, only the chunks of the crops are read, see _label_crop)
+            if not isinstance(label, ChunkedVolume):
+                label = np.asarray(label, dtype="uint8")
+        else:
+            label = None
+
+        # only the files of the selected modalities (and T1ce) are opened
+        img_list = []
+        for modality in self.input_modalities:
+            img, affine = self._load_nii(src_path, volume_dict[modality])
+            img_list.append(img)
+        img_t1ce, affine = self._load_nii(src_path, volume_dict[AUX_MODALITY])
+        return img_list, img_t1ce, label, affine
+
+    @staticmethod
+    def _label_crop(label, crop):
+        # uint8 GT of a crop, without copy for an array, only the chunks of the crop for a chunked volume
+        return np.asarray(label[crop], dtype="uint8")
+
+    def _required_volumes(self, src_path):
+        '''
+        data dicts of the modalities needed by the network
+        :return: dict modality -> data dict, and the GT data dict
+        '''
+        volume_list, seg_dict = self.data_dict_construct(src_path)
+        volume_dict = {v["mod"]: v for v in volume_list}
+        for modality in self.required_modalities:
+            if modality not in volume_dict:
+                raise Exception("modality %s missing in %s" % (modality, src_path))
+        return volume_dict, seg_dict
 
     # load volumes and the GT
     def load_volumes_label(self, src_path, rename_map_flag):
         '''
         this function get the volume data and gt from the giving path
         :param src_path: directory path of a patient
-        :return: GT and the volume data（width,height, slice, modality）
+        :return: GT and the volume data（width,height, slice, modality）and the affine of the volume
         '''
         # rename_map = [0, 1, 2, 4]
-        volume_list, seg_dict = self.data_dict_construct(src_path)
-        # assert len(volume_list) == 4
-        # assert seg_dict["mod"] == "seg"
-        if seg_dict["mod"] == "seg":
-            label_nib_data = nib.load(seg_dict["path"])
-            label = label_nib_data.get_data().copy()
-            # label = nib.load(seg_dict["path"]).get_data().copy()
-
-            # resolve the issue from resizing label, we first undertake binarization and then resize
-            stage1_label_data = np.zeros(label.shape, dtype='int32')
-            stage2_label_data = np.zeros(label.shape, dtype='int32')
-            stage3_label_data = np.zeros(label.shape, dtype='int32')
+        img_list, img_t1ce, label, affine = self._load_modalities(src_path)
+        if label is not None:
+            # whole GT
+            label = np.asarray(label, dtype="uint8")
             if rename_map_flag:
-                for i in range(len(self.rename_map)):
-                    if i > 0:
-                        stage1_label_data[label == self.rename_map[i]] = 1
-                    else:
-                        continue
-                # Cascaded structure，stage2,stage3 label prepare
-                stage2_label_data[label == 1] = 1
-                stage2_label_data[label == 4] = 1
-                stage3_label_data[label == 1] = 1
+                stage1_label_data, stage2_label_data, stage3_label_data = unpack_stage_labels(self.label_lut[label])
             else:
                 stage1_label_data = copy.deepcopy(label).astype('int16')
                 stage2_label_data = copy.deepcopy(label).astype('int16')
@@ -242,38 +711,12 @@ class BatchGenerator(Iterator):
             stage1_label_data = []
             stage2_label_data = []
             stage3_label_data = []
-            label_nib_data = []
-
-        img_all_modality = []
-        # order of the sequences [flair, T1, T1ce, T2]
-        for i in range(len(volume_list)):
-            volume = nib.load(volume_list[i]["path"])
-            img = volume.get_data().copy()
-            # resized_img = resize(img, resize_dim, order=1, preserve_range=True)
-            img_all_modality.append(img)
-
-        # choose different modalities for the network
-        if self.modalities == 4:
-            # all the modalities
-            img_data = img_all_modality
-        elif self.modalities == 3:
-            # select T1ce T1 Flair modalities
-            img_data = [img_all_modality[0], img_all_modality[2], img_all_modality[3]]
-        elif self.modalities == 2:
-            # two modalities
-            # choose T2 and Flair
-            img_data = [img_all_modality[0], img_all_modality[3]]
-        else:
-            # one modality
-            img_data = img_all_modality[0]
-            img_data = np.expand_dims(img_data, axis=0)
 
         # input volume data
-        img_data2 = np.expand_dims(img_all_modality[2], axis=0)
-        img_array2 = np.array(img_data2, "float32").transpose((1,2,3,0))
+        img_array2 = np.array(np.expand_dims(img_t1ce, axis=-1), "float32")
         # list to ndarray
-        img_array = np.array(img_data, "float32").transpose((1, 2, 3, 0))
-        return img_array, img_array2, stage1_label_data, stage2_label_data, stage3_label_data, volume
+        img_array = np.stack(img_list, axis=-1).astype("float32")
+        return img_array, img_array2, stage1_label_data, stage2_label_data, stage3_label_data, affine
 
     # construct data dict
     def data_dict_construct(self, path):
@@ -282,89 +725,22 @@ class BatchGenerator(Iterator):
         :param path: path of the patient data
         :return: list of dictionary including the path and the modality
         '''
-        # list the image volumes and GT
-        files = os.listdir(path)
-        nii_list = sorted(glob('{}/*.nii.gz'.format(path)))
-        re_style = r'[\-\_\.]+'
+        # the image volumes and GT are listed in the manifest
+        entry = self.manifest.get(path)
+        files = entry["files"] if entry is not None else scan_patient_files(path)
         volumn_list = []
         seg_dict = {"mod": "None"}
-        for count, nii in enumerate(nii_list):
-            # modality mapping [seg, flair, T1, T1ce, T2]
-            mapping = [0, 1, 2, 3, 4]
-            file = os.path.basename(nii)
-            split_text = re.split(re_style, file)
-            modality = split_text[-3]
-            assert modality in ["flair", "seg", "t1", "t2", "t1ce"]
-            if modality == "seg":
-                data_dict = {"mod": modality, "path": nii, "count": mapping[0]}
-            elif modality == "flair":
-                data_dict = {"mod": modality, "path": nii, "count": mapping[1]}
-            elif modality == "t1":
-                data_dict = {"mod": modality, "path": nii, "count": mapping[2]}
-            elif modality == "t1ce":
-                data_dict = {"mod": modality, "path": nii, "count": mapping[3]}
-            else:
-                data_dict = {"mod": modality, "path": nii, "count": mapping[4]}
-
-            if data_dict["mod"] != "seg":
+        for modality, nii in files.items():
+            data_dict = {"mod": modality, "path": nii, "count": MODALITY_SCHEMA[modality]}
+            if modality != "seg":
                 volumn_list.append(data_dict)
             else:
-                seg_dict = {"mod": modality, "path": nii, "count": mapping[0]}
+                seg_dict = data_dict
         # sort the modalites in the list
         volumn_list.sort(key=lambda x: x["count"])
         return volumn_list, seg_dict
 
 
-    def data_augment_volume(self, *datalist , augmentation):
-
-        # first get the volume data from the data list
-        image1, image2, image3, mask1, mask2, mask3 = datalist
-        # Augmentation
-        # This requires the imgaug lib (https://github.com/aleju/imgaug)
-        if augmentation:
-            import imgaug
-            # Augmenters that are safe to apply to masks
-            # Some, such as Affine, have settings that make them unsafe, so always
-            # test your augmentation on masks
-            MASK_AUGMENTERS = ["Sequential", "SomeOf", "OneOf", "Sometimes",
-                               "Fliplr", "Flipud", "CropAndPad",
-                               "Affine", "PiecewiseAffine"]
-
-            def hook(images, augmenter, parents, default):
-                """Determines which augmenters to apply to masks."""
-                return augmenter.__class__.__name__ in MASK_AUGMENTERS
-
-            # Store shapes before augmentation to compare
-            image1_shape = image1.shape
-            mask1_shape = mask1.shape
-            image2_shape = image2.shape
-            mask2_shape = mask2.shape
-            image3_shape = image3.shape
-            mask3_shape = mask3.shape
-            # Make augmenters deterministic to apply similarly to images and masks
-            det = augmentation.to_deterministic()
-            # image should be uint8!!
-            image1 = det.augment_image(image1)
-            image2 = det.augment_image(image2)
-            image3 = det.augment_image(image3)
-            # Change mask to np.uint8 because imgaug doesn't support np.bool
-            mask1 = det.augment_image(mask1.astype(np.uint8),
-                                       hooks=imgaug.HooksImages(activator=hook))
-            mask2 = det.augment_image(mask2.astype(np.uint8),
-                                      hooks=imgaug.HooksImages(activator=hook))
-            mask3 = det.augment_image(mask3.astype(np.uint8),
-                                      hooks=imgaug.HooksImages(activator=hook))
-            # Verify that shapes didn't change
-            assert image1.shape == image1_shape, "Augmentation shouldn't change image size"
-            assert mask1.shape == mask1_shape, "Augmentation shouldn't change mask size"
-            assert image2.shape == image2_shape, "Augmentation shouldn't change image size"
-            assert mask2.shape == mask2_shape, "Augmentation shouldn't change mask size"
-            assert image3.shape == image3_shape, "Augmentation shouldn't change image size"
-            assert mask3.shape == mask3_shape, "Augmentation shouldn't change mask size"
-            # Change mask back to bool
-            # masks = masks.astype(np.bool)
-        return image1,image2, image3, mask1, mask2, mask3
-
     def data_augment(self, image, mask, augmentation):
         # Augmentation
         # This requires the imgaug lib (https://github.com/aleju/imgaug)
@@ -399,24 +775,566 @@ class BatchGenerator(Iterator):
         return image, mask
 
 
-def get_brain_region(volume_data):
-    # volume = nib.load(volume_path)
-    # volume_data = volume.get_data()
-    # get the brain region
-    indice_list = np.where(volume_data > 0)
-    # calculate the min and max of the indice,  here volume have 3 channels
-    channel_0_min = min(indice_list[0])
-    channel_0_max = max(indice_list[0])
+def enlarged_box(regions, shape, extent):
+    '''
+    brain region enlarged (around its center) to hold at least a patch, within the volume
+    :param regions: (min, max) indices of the three axes
+    :param shape: shape of the volume
+    :param extent: size of the patch
+    :return: list of (start, end) of the three axes
+    '''
+    box = []
+    for axis in range(3):
+        length = min(max(regions[2 * axis + 1] - regions[2 * axis], extent), shape[axis])
+        start = (regions[2 * axis] + regions[2 * axis + 1] - length) // 2
+        start = max(0, min(start, shape[axis] - length))
+        box.append((int(start), int(start + length)))
+    return box
+
+
+def foreground_coords(codes):
+    '''
+    coordinates of the voxels of the classes WT/TC/NET
+    :param codes: bit-packed stage labels
+    :return: coordinates of all classes one after another (uint8 when possible), number of every class
+    '''
+    coord_type = "uint8" if max(codes.shape) <= 256 else "uint16"
+    coords = [np.argwhere((codes & (1 << k)) > 0).astype(coord_type) for k in range(3)]
+    return np.concatenate(coords, axis=0), np.array([len(c) for c in coords], dtype="int64")
+
+
+class PatientPool(object):
+    '''
+    recently loaded patients of a BatchGenerator, the least recently used ones are evicted when the
+    arrays of the pool exceed max_bytes
+    '''
 
-    channel_1_min = min(indice_list[1])
-    channel_1_max = max(indice_list[1])
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
 
-    channel_2_min = min(indice_list[2])
-    channel_2_max = max(indice_list[2])
+    @staticmethod
+    def entry_bytes(entry):
+        arrays = entry["img_list"] + [entry["img_t1ce"], entry["label"]]
+        # a chunked volume only holds its decompressed chunks
+        return sum(a.resident_bytes if isinstance(a, ChunkedVolume) else a.nbytes for a in arrays if a is not None)
 
-    brain_volume = volume_data[channel_0_min:channel_0_max, channel_1_min:channel_1_max,channel_2_min:channel_2_max]
+    def get(self, j):
+        return self.entries.get(j)
 
-    return (channel_0_min, channel_0_max, channel_1_min, channel_1_max, channel_2_min, channel_2_max)
+    def put(self, j, entry):
+        self.entries.pop(j, None)
+        self.entries[j] = entry
+        total_bytes = sum(self.entry_bytes(e) for e in self.entries.values())
+        # evict the finished patients first, the newest entry always stays
+        while total_bytes > self.max_bytes and len(self.entries) > 1:
+            finished = [k for k, e in self.entries.items() if e["remaining"] <= 0 and k != j]
+            evict = finished[0] if finished else next(iter(self.entries))
+            total_bytes -= self.entry_bytes(self.entries.pop(evict))
+
+    def values(self):
+        return list(self.entries.values())
+
+
+class BatchRing(object):
+    '''
+    num_slots preallocated batches of a BatchGenerator, in shared memory when they are filled by a loader
+    process. A slot is written in place by get_batch and recycled once the session has consumed it.
+    '''
+
+    def __init__(self, batch_specs, num_slots, shared):
+        self.batch_specs = batch_specs
+        self.num_slots = num_slots
+        self.shared = shared
+        self.buffers = []
+        for _ in range(num_slots):
+            if shared:
+                self.buffers.append([multiprocessing.RawArray("b", int(np.prod(shape)) * np.dtype(dtype).itemsize)
+                                     for shape, dtype in batch_specs])
+            else:
+                self.buffers.append([np.empty(shape, dtype=dtype) for shape, dtype in batch_specs])
+        self.slots = self._views()
+
+    def _views(self):
+        if not self.shared:
+            return self.buffers
+        return [[np.frombuffer(raw, dtype=dtype).reshape(shape) for raw, (shape, dtype) in zip(raws, self.batch_specs)]
+                for raws in self.buffers]
+
+    def __getstate__(self):
+        # the shared buffers go to the loader process, the views are built again there
+        state = self.__dict__.copy()
+        del state["slots"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.slots = self._views()
+
+
+def _prefetch_worker(generator, worker_id, num_workers, start_batch, queue, ring=None, free_slots=None):
+    # worker k produces the batches start_batch + k, start_batch + k + num_workers, ...
+    batch_index = start_batch + worker_id
+    try:
+        generator.set_worker(worker_id, num_workers)
+        while True:
+            if ring is None:
+                queue.put(generator.get_batch(batch_index))
+            else:
+                # fill a free slot of the shared ring, only its number goes through the queue
+                slot = free_slots.get()
+                generator.get_batch(batch_index, out=ring.slots[slot])
+                queue.put(slot)
+            batch_index += num_workers
+    except Exception:
+        queue.put(traceback.format_exc())
+
+
+class PrefetchLoader(object):
+    '''
+    multi-process loader keeping prefetch_depth batches of a BatchGenerator ready ahead of the optimizer.
+    Every batch is seeded by its batch number and the workers are read in turn, so the data stream
+    is the same for any number of workers (num_workers = 0 loads in the main process), except for the
+    per-worker state listed by BatchGenerator.stream_caveats (patient pools, record readers).
+    With shared_buffers the workers write the batches into preallocated shared-memory rings and the
+    returned arrays are views of a slot, valid until the next batch is requested.
+    '''
+
+    def __init__(self, generator, num_workers, prefetch_depth, start_batch=0, shared_buffers=True):
+        self.generator = generator
+        self.num_workers = num_workers
+        self.batch_index = start_batch
+        self.queues = []
+        self.workers = []
+        self.rings = []
+        self.free_slots = []
+        # slot of the batch returned last, recycled by the next call
+        self.used_slot = None
+        # every worker has its own bounded queue
+        queue_depth = max(1, int(np.ceil(prefetch_depth / max(num_workers, 1))))
+        if num_workers == 0:
+            # batches assembled in place in one reusable batch
+            self.rings.append(BatchRing(generator.batch_specs(), 1, shared=False))
+        for worker_id in range(num_workers):
+            queue = multiprocessing.Queue(maxsize=queue_depth)
+            if shared_buffers:
+                # queued slots, the slot being filled and the slot held by the session
+                ring = BatchRing(generator.batch_specs(), queue_depth + 2, shared=True)
+                free_slots = multiprocessing.Queue()
+                for slot in range(ring.num_slots):
+                    free_slots.put(slot)
+                self.rings.append(ring)
+                self.free_slots.append(free_slots)
+                args = (generator, worker_id, num_workers, start_batch, queue, ring, free_slots)
+            else:
+                args = (generator, worker_id, num_workers, start_batch, queue)
+            worker = multiprocessing.Process(target=_prefetch_worker, args=args)
+            worker.daemon = True
+            worker.start()
+            self.queues.append(queue)
+            self.workers.append(worker)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_workers == 0:
+            batch = self.generator.get_batch(self.batch_index, out=self.rings[0].slots[0])
+        else:
+            worker_id = self.batch_index % self.num_workers
+            if self.used_slot is not None:
+                # the previous batch has been consumed by the session
+                self.free_slots[self.used_slot[0]].put(self.used_slot[1])
+                self.used_slot = None
+            batch = self._get_batch(worker_id)
+            if isinstance(batch, str):
+                self.close()
+                raise Exception("loader worker failed:\n" + batch)
+            if self.rings:
+                self.used_slot = (worker_id, batch)
+                batch = tuple(self.rings[worker_id].slots[batch])
+        self.batch_index += 1
+        return batch
+
+    def next(self):
+        return self.__next__()
+
+    def _get_batch(self, worker_id, poll_interval=5.0):
+        '''
+        wait for the next batch of a worker. A worker killed by a signal (OOM killer, SIGKILL) cannot report
+        an exception, so the loader stops when the worker is no longer alive.
+        :return: batch, slot number or traceback of the worker
+        '''
+        while True:
+            try:
+                return self.queues[worker_id].get(timeout=poll_interval)
+            except Empty:
+                worker = self.workers[worker_id]
+                if not worker.is_alive():
+                    exitcode = worker.exitcode
+                    self.close()
+                    raise Exception("loader worker %d died with exit code %s" % (worker_id, exitcode))
+
+    def close(self):
+        for worker in self.workers:
+            worker.terminate()
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+
+def scan_patient_files(path):
+    '''
+    list the .nii.gz files of a patient directory
+    :return: dict modality -> file path
+    '''
+    return {parse_modality(nii): nii for nii in sorted(glob('{}/*.nii.gz'.format(path)))}
+
+
+class DatasetManifest(object):
+    '''
+    manifest of a dataset (category/patient/*.nii.gz) with the modality files, shapes, dtypes and affine
+    of every patient, plus its brain region and intensity statistics once they are computed. It is saved
+    as JSON, rebuilt when a directory of the dataset changes and a patient entry is rebuilt when one of its
+    files changes (a file rewritten in place keeps the mtime of its directory).
+    '''
+
+    def __init__(self, volume_path, manifest_path=None):
+        self.volume_path = volume_path
+        self.manifest_path = manifest_path
+        # worker processes use the manifest read-only
+        self.owner_pid = os.getpid()
+        self.dirty = False
+        self.dir_stamp = None
+        patients = None
+        old_patients = []
+        if manifest_path and os.path.exists(manifest_path):
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            old_patients = manifest["patients"]
+            if self._dir_stamp(manifest["dir_stamp"].keys()) == manifest["dir_stamp"]:
+                patients = self._refresh(old_patients)
+                self.dir_stamp = manifest["dir_stamp"]
+        if patients is None:
+            patients = self._build(old_patients)
+        self.patients = patients
+        self.index = {p["path"]: p for p in patients}
+        self.save()
+
+    @staticmethod
+    def default_path(manifest_dir, volume_path):
+        '''
+        :return: path of the manifest of volume_path in manifest_dir, one file per dataset
+        '''
+        return os.path.join(manifest_dir, dataset_key(volume_path) + ".json")
+
+    def _dir_stamp(self, rel_dirs):
+        # mtime of a directory changes when entries are added, removed or renamed
+        stamp = {}
+        for rel_dir in rel_dirs:
+            try:
+                stamp[rel_dir] = os.stat(os.path.join(self.volume_path, rel_dir)).st_mtime
+            except OSError:
+                stamp[rel_dir] = None
+        return stamp
+
+    def _refresh(self, old_patients):
+        '''
+        rebuild the entries of the patients whose files changed since the manifest was saved
+        :return: list of the patient entries, None when a file is missing (the manifest is rebuilt)
+        '''
+        old_index = {p["path"]: p for p in old_patients}
+        patients = []
+        for old in old_patients:
+            try:
+                stamps = self._file_stamps(old["files"])
+            except OSError:
+                return None
+            if stamps == old["stamps"]:
+                patients.append(old)
+            else:
+                patients.append(self._patient_entry(old["path"], old["category"], old_index))
+                self.dirty = True
+        return patients
+
+    @staticmethod
+    def _file_stamps(files):
+        stamps = {}
+        for modality, nii_path in files.items():
+            stat = os.stat(nii_path)
+            stamps[modality] = [stat.st_mtime, stat.st_size]
+        return stamps
+
+    def _build(self, old_patients):
+        start_time = time.time()
+        old_index = {p["path"]: p for p in old_patients}
+        patients = []
+        rel_dirs = [""]
+        for category in sorted(os.listdir(self.volume_path)):
+            category_path = os.path.join(self.volume_path, category)
+            if not os.path.isdir(category_path):
+                continue
+            rel_dirs.append(category)
+            for dire in sorted(os.listdir(category_path)):
+                if not dire.lower().startswith('brats'):
+                    raise Exception("volume file exception!")
+                rel_dirs.append(os.path.join(category, dire))
+                patients.append(self._patient_entry(os.path.join(category_path, dire), category, old_index))
+        self.dir_stamp = self._dir_stamp(rel_dirs)
+        self.dirty = True
+        print("dataset manifest built: %d patients (%.1fs)" % (len(patients), time.time() - start_time))
+        return patients
+
+    @staticmethod
+    def _patient_entry(path, category, old_index):
+        files = scan_patient_files(path)
+        stamps = DatasetManifest._file_stamps(files)
+        old = old_index.get(path)
+        if old is not None and old["files"] == files and old["stamps"] == stamps:
+            # unchanged patient, keep what has been computed
+            return old
+        # only the headers are read
+        headers = {modality: nib.load(nii_path) for modality, nii_path in files.items()}
+        reference = headers[AUX_MODALITY] if AUX_MODALITY in headers else next(iter(headers.values()))
+        return {"name": os.path.basename(path), "category": category, "path": path,
+                "files": files, "stamps": stamps,
+                "shape": [int(d) for d in reference.shape],
+                "dtypes": {modality: str(h.get_data_dtype()) for modality, h in headers.items()},
+                "affine": reference.affine.tolist(),
+                "brain_region": None, "stats": {}}
+
+    def get(self, path):
+        return self.index.get(path)
+
+    def update(self, path, **fields):
+        self.index[path].update(fields)
+        self.dirty = True
+
+    def save(self):
+        if not (self.dirty and self.manifest_path) or os.getpid() != self.owner_pid:
+            return
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp_path = self.manifest_path + ".%d.tmp" % os.getpid()
+        with open(tmp_path, "w") as f:
+            json.dump({"volume_path": self.volume_path, "dir_stamp": self.dir_stamp,
+                       "patients": self.patients}, f)
+        os.replace(tmp_path, self.manifest_path)
+        self.dirty = False
+
+
+class VolumeCache(object):
+    '''
+    on-disk cache of the decompressed patient volumes. Every modality (and the GT) is saved once as an
+    uncompressed .npy file which is memory-mapped afterwards, or as compressed chunks of which a patch
+    only reads the intersecting ones (cache_format = chunked), so the .nii.gz files are only
+    decompressed again when their mtime or size changes.
+    '''
+
+    def __init__(self, cache_dir, volume_path, cache_format="npy", chunk_codec="zlib", chunk_size=32):
+        # one sub directory per dataset
+        self.root = os.path.join(cache_dir, dataset_key(volume_path))
+        if cache_format not in ("npy", "chunked"):
+            raise Exception("unknown cache format: %s" % cache_format)
+        self.cache_format = cache_format
+        self.chunk_codec = chunk_codec
+        self.chunk_size = chunk_size
+
+    def _patient_dir(self, src_path):
+        # keep the HGG/LGG level to stay unique
+        src_path = os.path.normpath(src_path)
+        return os.path.join(self.root, os.path.basename(os.path.dirname(src_path)), os.path.basename(src_path))
+
+    @staticmethod
+    def _source_stamp(nii_path):
+        stat = os.stat(nii_path)
+        return {"source": os.path.abspath(nii_path), "mtime": stat.st_mtime, "size": stat.st_size}
+
+    @staticmethod
+    def _read_valid_stamp(npy_path, stamp_path, sources):
+        # the cached array is valid when all its source files are unchanged
+        if not (os.path.exists(npy_path) and os.path.exists(stamp_path)):
+            return None
+        with open(stamp_path, "r") as f:
+            cached_stamp = json.load(f)
+        if cached_stamp.get("sources") != sources:
+            return None
+        return cached_stamp
+
+    @staticmethod
+    def _save(npy_path, stamp_path, data, stamp, writer=None):
+        os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+        # write to temporary files first, several loaders may fill the cache at the same time
+        tmp_suffix = ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+        with open(npy_path + tmp_suffix, "wb") as f:
+            if writer is not None:
+                writer(f, data)
+            elif isinstance(data, dict):
+                np.savez(f, **data)
+            else:
+                np.save(f, np.ascontiguousarray(data))
+        os.replace(npy_path + tmp_suffix, npy_path)
+        with open(stamp_path + tmp_suffix, "w") as f:
+            json.dump(stamp, f)
+        os.replace(stamp_path + tmp_suffix, stamp_path)
+
+    def load(self, src_path, modality, nii_path):
+        '''
+        get the volume data of one modality, from the cache if it is still valid
+        :param src_path: directory path of a patient
+        :param modality: flair/t1/t1ce/t2/seg
+        :param nii_path: path of the source .nii.gz file
+        :return: memory-mapped (or chunked) volume data and the affine of the volume
+        '''
+        patient_dir = self._patient_dir(src_path)
+        stamp_path = os.path.join(patient_dir, modality + ".json")
+        sources = [self._source_stamp(nii_path)]
+        if self.cache_format == "chunked":
+            data_path = os.path.join(patient_dir, modality + ".chunks")
+
+            def open_volume():
+                return ChunkedVolume(data_path)
+
+            def writer(f, data):
+                write_chunked(f, data, self.chunk_size, self.chunk_codec)
+        else:
+            data_path = os.path.join(patient_dir, modality + ".npy")
+
+            def open_volume():
+                return np.load(data_path, mmap_mode="r")
+
+            writer = None
+        cached_stamp = self._read_valid_stamp(data_path, stamp_path, sources)
+        if cached_stamp is not None:
+            return open_volume(), np.array(cached_stamp["affine"])
+        # (re)build the cache of this modality
+        volume = nib.load(nii_path)
+        data = volume.get_data()
+        if modality == "seg":
+            data = data.astype("uint8")
+        self._save(data_path, stamp_path, data, {"sources": sources, "affine": volume.affine.tolist()}, writer)
+        return open_volume(), volume.affine
+
+    def derived(self, src_path, name, nii_paths, compute, settings=None):
+        '''
+        get arrays derived from the volumes of a patient (e.g. intensity CDFs), they are computed only once
+        :param src_path: directory path of a patient
+        :param name: name of the derived arrays
+        :param nii_paths: source .nii.gz files the arrays depend on
+        :param compute: function returning a dict of arrays when the cache is invalid
+        :param settings: JSON-serializable settings the arrays depend on, the arrays are computed again
+                         when they change
+        :return: dict of the derived arrays
+        '''
+        patient_dir = self._patient_dir(src_path)
+        npz_path = os.path.join(patient_dir, name + ".npz")
+        stamp_path = os.path.join(patient_dir, name + ".json")
+        sources = [self._source_stamp(nii_path) for nii_path in nii_paths]
+        cached_stamp = self._read_valid_stamp(npz_path, stamp_path, sources)
+        if cached_stamp is not None and cached_stamp.get("settings") == settings:
+            with np.load(npz_path) as archive:
+                return dict(archive)
+        data = compute()
+        self._save(npz_path, stamp_path, data, {"sources": sources, "settings": settings})
+        return data
+
+
+class SharedVolumePool(object):
+    '''
+    node-local pool of decoded volumes in shared memory (a tmpfs directory such as /dev/shm), keyed by
+    dataset, patient and modality. A volume is written once by the first process needing it and every
+    BatchGenerator of the node memory-maps the same pages. The least recently used volumes are removed
+    when the pool exceeds max_bytes; processes still mapping a removed volume keep their pages.
+    '''
+
+    def __init__(self, pool_dir, volume_path, max_bytes):
+        self.pool_dir = pool_dir
+        self.root = os.path.join(pool_dir, dataset_key(volume_path))
+        self.max_bytes = max_bytes
+        os.makedirs(self.root, exist_ok=True)
+
+    def _volume_path(self, src_path, modality):
+        src_path = os.path.normpath(src_path)
+        name = "%s__%s__%s" % (os.path.basename(os.path.dirname(src_path)), os.path.basename(src_path), modality)
+        return os.path.join(self.root, name + ".npy")
+
+    def _lock(self):
+        # one writer/evictor at a time over all the datasets of the pool
+        lock_file = open(os.path.join(self.pool_dir, ".lock"), "w")
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        return lock_file
+
+    def _evict(self, keep_path):
+        volumes = []
+        for root, _, names in os.walk(self.pool_dir):
+            for name in names:
+                if name.endswith(".npy"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    volumes.append((stat.st_mtime, stat.st_size, path))
+        total_bytes = sum(size for _, size, _ in volumes)
+        for _, size, path in sorted(volumes):
+            if total_bytes <= self.max_bytes:
+                break
+            if path == keep_path:
+                continue
+            for remove_path in (path, path[:-len(".npy")] + ".json"):
+                try:
+                    os.remove(remove_path)
+                except OSError:
+                    pass
+            total_bytes -= size
+
+    def load(self, src_path, modality, nii_path, load_source):
+        '''
+        get a volume from the pool, it is added from load_source when missing or outdated
+        :param src_path: directory path of a patient
+        :param modality: flair/t1/t1ce/t2/seg
+        :param nii_path: source .nii.gz file, its mtime and size validate the pooled volume
+        :param load_source: function returning the volume data and the affine
+        :return: memory-mapped volume data and the affine
+        '''
+        npy_path = self._volume_path(src_path, modality)
+        stamp_path = npy_path[:-len(".npy")] + ".json"
+        sources = [VolumeCache._source_stamp(nii_path)]
+        try:
+            cached_stamp = VolumeCache._read_valid_stamp(npy_path, stamp_path, sources)
+            if cached_stamp is not None:
+                # most recently used
+                os.utime(npy_path)
+                return np.load(npy_path, mmap_mode="r"), np.array(cached_stamp["affine"])
+        except (OSError, ValueError):
+            # evicted by another process in the meantime
+            pass
+        data, affine = load_source()
+        data = np.asarray(data, dtype="uint8") if modality == "seg" else np.asarray(data)
+        lock_file = self._lock()
+        try:
+            VolumeCache._save(npy_path, stamp_path, data, {"sources": sources, "affine": np.asarray(affine).tolist()})
+            self._evict(npy_path)
+            volume = np.load(npy_path, mmap_mode="r")
+        finally:
+            lock_file.close()
+        return volume, affine
+
+
+def get_brain_region(volume_data):
+    '''
+    bounding box of the brain (voxels > 0) from the projections of the volume on every axis,
+    only O(H+W+D) memory is allocated
+    :param volume_data: 3D volume
+    :return: (min, max) indices of the three axes
+    '''
+    region = []
+    for axis in range(3):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        indices = np.flatnonzero(np.max(volume_data, axis=other_axes) > 0)
+        if len(indices) == 0:
+            raise Exception("no brain region in the volume!")
+        region += [int(indices[0]), int(indices[-1])]
+    return tuple(region)
 
 
 class Preprocessing(object):
@@ -451,11 +1369,22 @@ class Preprocessing(object):
 
     # normalize the data(zero mean and unit variance)
     @staticmethod
-    def Normalization(volume, axis=None):
+    def Normalization(volume, axis=None, stats=None, out=None):
+        if stats is None:
+            mean, std = Preprocessing.normalization_stats(volume, axis)
+        else:
+            mean, std = stats
+        # written in place when an output array is given
+        norm_volume = np.subtract(volume, mean, out=out)
+        norm_volume /= std
+        return norm_volume
+
+    # mean and standard deviation for the normalization, computed once for a whole volume
+    @staticmethod
+    def normalization_stats(volume, axis=None):
         mean = np.mean(volume, axis=axis)
         std = np.std(volume, axis=axis)
-        norm_volume = (volume - mean) / std
-        return norm_volume
+        return mean, std
 
     # data augmentation by histogram matching
     @staticmethod
@@ -502,6 +1431,65 @@ class Preprocessing(object):
 
         return interp_t_values[bin_idx].reshape(oldshape)
 
+    # empirical cumulative distribution function of the intensities
+    @staticmethod
+    def intensity_cdf(volume, n_quantiles=256):
+        '''
+        foreground (>0) intensity values of a volume at evenly spaced quantiles, small enough to be
+        precomputed for every patient and used by hist_match_cdf instead of the whole template volume
+        :param volume: input volume data
+        :param n_quantiles: number of quantiles between 0 and 1
+        :return: intensity values of the quantiles
+        '''
+        foreground = volume[volume > 0]
+        if foreground.size == 0:
+            foreground = np.zeros(1, dtype="float32")
+        quantiles = np.linspace(0, 100, n_quantiles)
+        return np.percentile(foreground, quantiles).astype("float32")
+
+    # normalization statistics of a volume after hist_match_cdf
+    @staticmethod
+    def matched_stats(stats, source_cdf, template_cdf):
+        '''
+        (mean, std) of a volume after hist_match_cdf, without the matched volume: the foreground of the source
+        (its fraction of the region of the statistics is the source mean over the mean foreground intensity)
+        takes the intensity distribution of the template, the background stays zero
+        :param stats: (mean, std) of the source volume
+        :param source_cdf: intensity_cdf of the source volume
+        :param template_cdf: intensity_cdf of the template volume
+        :return: mean and standard deviation of the matched volume
+        '''
+        source_mean = np.mean(source_cdf, dtype="float64")
+        fraction = min(stats[0] / source_mean, 1.0) if source_mean > 0 else 0.0
+        mean = fraction * np.mean(template_cdf, dtype="float64")
+        second_moment = fraction * np.mean(np.square(template_cdf, dtype="float64"))
+        std = np.sqrt(max(second_moment - mean ** 2, 0.0))
+        return mean, std if std > 0 else 1.0
+
+    # data augmentation by histogram matching against precomputed CDFs
+    @staticmethod
+    def hist_match_cdf(source, source_cdf, template_cdf):
+        '''
+        same as hist_match, the source and the template are described by intensity_cdf. The background
+        stays zero so that the brain region is not changed.
+        :param source: image to transform
+        :param source_cdf: intensity_cdf of the source image
+        :param template_cdf: intensity_cdf of the template image
+        :return: the transformed output image
+        '''
+        quantiles = np.linspace(0, 1, len(source_cdf))
+
+        def strictly_increasing(values):
+            # repeated intensities (e.g. the background) keep their highest quantile, like np.unique+cumsum
+            reversed_values, index = np.unique(values[::-1], return_index=True)
+            return reversed_values, quantiles[::-1][index]
+
+        s_values, s_quantiles = strictly_increasing(source_cdf)
+        t_values, t_quantiles = strictly_increasing(template_cdf)
+        source_quantiles = np.interp(source, s_values, s_quantiles)
+        matched = np.interp(source_quantiles, t_quantiles, t_values).astype("float32")
+        return np.where(source > 0, matched, 0).astype("float32")
+
     # data augmentation by deforming
     @staticmethod
     def produceRandomlyDeformedImage(image, label, numcontrolpoints, stdDef, seed=1):
@@ -728,147 +1716,186 @@ def fit_cube_param(vol_dim, cube_size, ita):
     return fold, ovlap
 
 
-# decompose volume into list of cubes
+# start of the cubes along every axis
+def cube_axis_starts(vol_dim, cube_size, ita):
+    fold, ovlap = fit_cube_param(vol_dim, cube_size, ita)
+    axis_starts = []
+    for d in range(3):
+        starts = []
+        for R in range(0, fold[d]):
+            start = R * cube_size - R * ovlap[d]
+            if start + cube_size >= vol_dim[d]:  # see if exceed the boundry
+                start = vol_dim[d] - cube_size
+            starts.append(int(start))
+        axis_starts.append(starts)
+    return axis_starts
+
+
+# start of every cube of a volume, in the order of the compose functions
+def cube_coords(vol_dim, cube_size, ita):
+    r_starts, c_starts, h_starts = cube_axis_starts(vol_dim, cube_size, ita)
+    for r_s in r_starts:
+        for c_s in c_starts:
+            for h_s in h_starts:
+                yield r_s, c_s, h_s
+
+
+# decompose volume into list of cubes (batches of one cube), in the order of the compose functions
 def decompose_vol2cube_brain(vol_data, cube_size, n_chn, ita):
-    cube_list = []
-    fold, ovlap = fit_cube_param(vol_data.shape[0:3], cube_size, ita)
-    dim = np.asarray(vol_data.shape[0:3])  # [307, 307, 143]
-    # decompose
-    for R in range(0, fold[0]):
-        r_s = R * cube_size - R * ovlap[0]
-        r_e = r_s + cube_size
-        if r_e >= dim[0]:  # see if exceed the boundry
-            r_s = dim[0] - cube_size
-            r_e = r_s + cube_size
-        for C in range(0, fold[1]):
-            c_s = C * cube_size - C * ovlap[1]
-            c_e = c_s + cube_size
-            if c_e >= dim[1]:
-                c_s = dim[1] - cube_size
-                c_e = c_s + cube_size
-            for H in range(0, fold[2]):
-                h_s = H * cube_size - H * ovlap[2]
-                h_e = h_s + cube_size
-                if h_e >= dim[2]:
-                    h_s = dim[2] - cube_size
-                    h_e = h_s + cube_size
-                # partition multiple channels
-                cube_temp = vol_data[r_s:r_e, c_s:c_e, h_s:h_e, :]
-                # By default batch_size = 1
-                cube_batch = np.zeros(
-                    [1, cube_size, cube_size, cube_size, n_chn]).astype('float32')
-                cube_batch[0, :, :, :, :] = copy.deepcopy(cube_temp)
-                # save
-                cube_list.append(cube_batch)
-
-    return cube_list
+    if vol_data.shape[-1] != n_chn:
+        raise Exception("volume with %d channels, expected %d" % (vol_data.shape[-1], n_chn))
+    return [cubes[0].copy() for _, cubes in cube_batches([vol_data], cube_size, ita, 1)]
+
+
+# summed volume table of a mask, with a row of zeros before the first voxel of every axis
+def integral_volume(mask):
+    integral = np.zeros([d + 1 for d in mask.shape[0:3]], dtype="int32")
+    integral[1:, 1:, 1:] = np.cumsum(mask, axis=0, dtype="int32").cumsum(axis=1).cumsum(axis=2)
+    return integral
+
+
+# number of voxels of a mask in the box [start, end) of every axis, read from the integral volume of the mask
+def box_sum(integral, start, end):
+    r0, c0, h0 = start
+    r1, c1, h1 = end
+    return int(integral[r1, c1, h1] - integral[r0, c1, h1] - integral[r1, c0, h1] - integral[r1, c1, h0] +
+               integral[r0, c0, h1] + integral[r0, c1, h0] + integral[r1, c0, h0] - integral[r0, c0, h0])
+
+
+# number of voxels of a mask in the cube at start, read from the integral volume of the mask
+def cube_occupancy(integral, start, cube_size):
+    return box_sum(integral, start, [c + cube_size for c in start])
+
+
+def cube_batches(volumes, cube_size, ita, batch_size, starts=None):
+    '''
+    iterate over the cubes of volumes by batches, the cubes are copied into batch buffers allocated once, so
+    the memory does not depend on the number of cubes (overlap factor)
+    :param volumes: list of volumes with the same first three dimensions (channels last)
+    :param cube_size: edge length of the cubes
+    :param ita: cube overlap factor
+    :param batch_size: number of cubes in a batch
+    :param starts: starts of the cubes to iterate over, all the cubes of cube_coords by default
+    :return: generator of (cube starts, list of the batch of every volume), the batches are overwritten by the
+             next iteration and the last one may be smaller
+    '''
+    buffers = [np.empty([batch_size, cube_size, cube_size, cube_size, volume.shape[-1]], dtype="float32")
+               for volume in volumes]
+    if starts is None:
+        starts = cube_coords(volumes[0].shape[0:3], cube_size, ita)
+    batch_starts = []
+    for start in starts:
+        crop = tuple(slice(c, c + cube_size) for c in start)
+        for buffer, volume in zip(buffers, volumes):
+            buffer[len(batch_starts)] = volume[crop]
+        batch_starts.append(start)
+        if len(batch_starts) == batch_size:
+            yield batch_starts, buffers
+            batch_starts = []
+    if batch_starts:
+        yield batch_starts, [buffer[:len(batch_starts)] for buffer in buffers]
+
+
+class CubeCompositor(object):
+    '''
+    streaming composition of the predicted cubes of a volume: the cubes are accumulated as they are predicted
+    (votes of the labels or sum of the probabilities) and none of them is kept. The number of cubes covering a
+    voxel is the product of the counts of the three axes, it is computed from the cube positions instead of
+    being accumulated.
+    '''
+
+    def __init__(self, vol_dim, cube_size, ita, class_n, probability=False):
+        '''
+        :param vol_dim: shape of the volume
+        :param cube_size: edge length of the cubes
+        :param ita: cube overlap factor
+        :param class_n: number of classes
+        :param probability: accumulate probability cubes (float16 sums) instead of label cubes (votes)
+        '''
+        self.vol_dim = tuple(int(d) for d in vol_dim[0:3])
+        self.cube_size = cube_size
+        self.class_n = class_n
+        self.probability = probability
+        self.axis_counts = []
+        for dim, starts in zip(self.vol_dim, cube_axis_starts(self.vol_dim, cube_size, ita)):
+            count = np.zeros(dim, dtype="int32")
+            for start in starts:
+                count[start:start + cube_size] += 1
+            self.axis_counts.append(count)
+        max_count = int(np.prod([count.max() for count in self.axis_counts]))
+        self.count_dtype = "uint8" if max_count <= np.iinfo("uint8").max else "uint16"
+        if probability:
+            self.sums = np.zeros(self.vol_dim + (class_n,), dtype="float16")
+        else:
+            # the votes of the background are the count minus the votes of the other classes
+            self.votes = np.zeros(self.vol_dim + (class_n - 1,), dtype=self.count_dtype)
+
+    def count(self):
+        '''
+        :return: number of cubes covering every voxel
+        '''
+        r_count, c_count, h_count = [count.astype(self.count_dtype) for count in self.axis_counts]
+        return r_count[:, None, None] * c_count[None, :, None] * h_count[None, None, :]
+
+    def add(self, starts, cubes):
+        '''
+        accumulate a batch of predicted cubes
+        :param starts: start of every cube (see cube_coords)
+        :param cubes: label cubes (cube_size^3) or probability cubes (cube_size^3 x class_n)
+        '''
+        for (r_s, c_s, h_s), cube in zip(starts, cubes):
+            crop = (slice(r_s, r_s + self.cube_size), slice(c_s, c_s + self.cube_size),
+                    slice(h_s, h_s + self.cube_size))
+            if self.probability:
+                self.sums[crop] += cube
+            else:
+                votes = self.votes[crop]
+                for k in range(1, self.class_n):
+                    votes[..., k - 1] += cube == k
+
+    def add_background(self, starts):
+        '''
+        accumulate cubes predicted as background without running the network
+        :param starts: start of every cube (see cube_coords)
+        '''
+        if not self.probability:
+            # the background votes are implicit (count minus the votes of the other classes)
+            return
+        for r_s, c_s, h_s in starts:
+            self.sums[r_s:r_s + self.cube_size, c_s:c_s + self.cube_size, h_s:h_s + self.cube_size, 0] += 1
+
+    def label(self):
+        '''
+        :return: label volume, class with the most votes (the lowest class on ties)
+        '''
+        if self.probability:
+            return np.argmax(self.sums, axis=3)
+        background = self.count() - self.votes.sum(axis=3, dtype=self.count_dtype)
+        return np.argmax(np.concatenate([background[..., None], self.votes], axis=3), axis=3)
+
+    def prob(self):
+        '''
+        :return: probability volume, average of the cubes (0 outside of them)
+        '''
+        count = self.count().astype("float32")
+        count[count == 0] = 1.0
+        return self.sums.astype("float32") / count[..., None]
 
 
 # compose list of label cubes into a label volume
 def compose_label_cube2vol(cube_list, vol_dim, cube_size, ita, class_n):
-    # get parameters for compose
-    fold, ovlap = fit_cube_param(vol_dim, cube_size, ita)
-    # create label volume for all classes
-    label_classes_mat = (
-        np.zeros([vol_dim[0], vol_dim[1], vol_dim[2], class_n])).astype('int32')
-    idx_classes_mat = (
-        np.zeros([cube_size, cube_size, cube_size, class_n])).astype('int32')
-
-    p_count = 0
-    for R in range(0, fold[0]):
-        r_s = R * cube_size - R * ovlap[0]
-        r_e = r_s + cube_size
-        if r_e >= vol_dim[0]:
-            r_s = vol_dim[0] - cube_size
-            r_e = r_s + cube_size
-        for C in range(0, fold[1]):
-            c_s = C * cube_size - C * ovlap[1]
-            c_e = c_s + cube_size
-            if c_e >= vol_dim[1]:
-                c_s = vol_dim[1] - cube_size
-                c_e = c_s + cube_size
-            for H in range(0, fold[2]):
-                h_s = H * cube_size - H * ovlap[2]
-                h_e = h_s + cube_size
-                if h_e >= vol_dim[2]:
-                    h_s = vol_dim[2] - cube_size
-                    h_e = h_s + cube_size
-                # histogram for voting (one-hot)
-                for k in range(class_n):
-                    idx_classes_mat[:, :, :, k] = (cube_list[p_count] == k)
-                # accumulation
-                label_classes_mat[r_s:r_e,
-                                  c_s:c_e,
-                                  h_s:h_e,
-                                  :] = label_classes_mat[r_s:r_e,
-                                                         c_s:c_e,
-                                                         h_s:h_e,
-                                                         :] + idx_classes_mat
-
-                p_count += 1
-    # print 'label mat unique:'
-    # print np.unique(label_mat)
-
-    compose_vol = np.argmax(label_classes_mat, axis=3)
-    # print np.unique(label_mat)
-
-    return compose_vol
+    compositor = CubeCompositor(vol_dim, cube_size, ita, class_n)
+    for start, cube in zip(cube_coords(vol_dim, cube_size, ita), cube_list):
+        compositor.add([start], np.reshape(cube, (1, cube_size, cube_size, cube_size)))
+    return compositor.label()
 
 
 # compose list of probability cubes into a probability volumes
 def compose_prob_cube2vol(cube_list, vol_dim, cube_size, ita, class_n):
-    # get parameters for compose
-    fold, ovlap = fit_cube_param(vol_dim, cube_size, ita)
-    # create label volume for all classes
-    map_classes_mat = (
-        np.zeros([vol_dim[0], vol_dim[1], vol_dim[2], class_n])).astype('float32')
-    cnt_classes_mat = (
-        np.zeros([vol_dim[0], vol_dim[1], vol_dim[2], class_n])).astype('float32')
-
-    p_count = 0
-    for R in range(0, fold[0]):
-        r_s = R * cube_size - R * ovlap[0]
-        r_e = r_s + cube_size
-        if r_e >= vol_dim[0]:
-            r_s = vol_dim[0] - cube_size
-            r_e = r_s + cube_size
-        for C in range(0, fold[1]):
-            c_s = C * cube_size - C * ovlap[1]
-            c_e = c_s + cube_size
-            if c_e >= vol_dim[1]:
-                c_s = vol_dim[1] - cube_size
-                c_e = c_s + cube_size
-            for H in range(0, fold[2]):
-                h_s = H * cube_size - H * ovlap[2]
-                h_e = h_s + cube_size
-                if h_e >= vol_dim[2]:
-                    h_s = vol_dim[2] - cube_size
-                    h_e = h_s + cube_size
-                # accumulation
-                map_classes_mat[r_s:r_e,
-                                c_s:c_e,
-                                h_s:h_e,
-                                :] = map_classes_mat[r_s:r_e,
-                                                     c_s:c_e,
-                                                     h_s:h_e,
-                                                     :] + cube_list[p_count]
-                cnt_classes_mat[r_s:r_e,
-                                c_s:c_e,
-                                h_s:h_e,
-                                :] = cnt_classes_mat[r_s:r_e,
-                                                     c_s:c_e,
-                                                     h_s:h_e,
-                                                     :] + 1.0
-
-                p_count += 1
-
-    # elinimate NaN
-    nan_idx = (cnt_classes_mat == 0)
-    cnt_classes_mat[nan_idx] = 1.0
-    # average
-    compose_vol = map_classes_mat / cnt_classes_mat
-
-    return compose_vol
+    compositor = CubeCompositor(vol_dim, cube_size, ita, class_n, probability=True)
+    for start, cube in zip(cube_coords(vol_dim, cube_size, ita), cube_list):
+        compositor.add([start], np.reshape(cube, (1, cube_size, cube_size, cube_size, class_n)))
+    return compositor.prob()
 
 
 # Remove small connected components
@@ -1076,7 +2103,7 @@ def load_train_ini(ini_file):
                           inputI_chn=cf.getint(s[d], "inputI_chn"),
                           outputI_size=cf.getint(s[d], "outputI_size"),
                           output_chn=cf.getint(s[d], "output_chn"),
-                          rename_map=cf.get(s[d], "rename_map"),
+                          rename_map=[int(v) for v in cf.get(s[d], "rename_map").split(',')],
                           resize_r=cf.getfloat(s[d], "resize_r"),
                           traindata_dir=cf.get(s[d], "traindata_dir"),
                           chkpoint_dir=cf.get(s[d], "chkpoint_dir"),
@@ -1088,13 +2115,41 @@ def load_train_ini(ini_file):
                           testdata_dir=cf.get(s[d], "testdata_dir"),
                           labeling_dir=cf.get(s[d], "labeling_dir"),
                           ovlp_ita=cf.getint(s[d], "ovlp_ita"),
+                          test_batch_size=cf.getint(s[d], "test_batch_size"),
+                          cube_min_occupancy=cf.getfloat(s[d], "cube_min_occupancy"),
+                          gated_inference=cf.getboolean(s[d], "gated_inference"),
+                          gate_margin=cf.getint(s[d], "gate_margin"),
+                          coarse_to_fine=cf.getboolean(s[d], "coarse_to_fine"),
+                          coarse_resize_r=cf.getfloat(s[d], "coarse_resize_r"),
+                          roi_margin=cf.getint(s[d], "roi_margin"),
+                          test_bn_mode=cf.get(s[d], "test_bn_mode"),
+                          frozen_graph=cf.get(s[d], "frozen_graph"),
                           step=cf.getint(s[d], "step"),
                           Stages=cf.getint(s[d], "Stages"),
                           Blocks=cf.getint(s[d], "Blocks"),
                           Columns=cf.getint(s[d], "Columns"),
                           fg_ratio=cf.getfloat(s[d], "fg_ratio"),
                           bg_ratio=cf.getfloat(s[d], "bg_ratio"),
-                          focal_loss_flag=cf.getboolean(s[d], "focal_loss_flag"))
+                          focal_loss_flag=cf.getboolean(s[d], "focal_loss_flag"),
+                          cache_dir=cf.get(s[d], "cache_dir"),
+                          manifest_dir=cf.get(s[d], "manifest_dir"),
+                          hist_match=cf.getboolean(s[d], "hist_match"),
+                          aug_report_intval=cf.getint(s[d], "aug_report_intval"),
+                          record_dir=cf.get(s[d], "record_dir"),
+                          shuffle_buffer=cf.getint(s[d], "shuffle_buffer"),
+                          input_mode=cf.get(s[d], "input_mode"),
+                          dataset_cache=cf.get(s[d], "dataset_cache"),
+                          cache_format=cf.get(s[d], "cache_format"),
+                          shared_buffers=cf.getboolean(s[d], "shared_buffers"),
+                          chunk_codec=cf.get(s[d], "chunk_codec"),
+                          shm_dir=cf.get(s[d], "shm_dir"),
+                          shm_pool_mb=cf.getint(s[d], "shm_pool_mb"),
+                          num_workers=cf.getint(s[d], "num_workers"),
+                          prefetch_depth=cf.getint(s[d], "prefetch_depth"),
+                          fg_sample_ratio=cf.getfloat(s[d], "fg_sample_ratio"),
+                          patches_per_volume=cf.getint(s[d], "patches_per_volume"),
+                          pool_interleave=cf.getint(s[d], "pool_interleave"),
+                          pool_size_mb=cf.getint(s[d], "pool_size_mb"))
         # add to list
         param_sections.append(level_dict)
 